@@ -0,0 +1,42 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from DatabaseManager.DatabaseManager import DatabaseManager
+from core.metrics import DB_QUERY_DURATION
+
+
+class AsyncDatabaseManager:
+    # Exposes every DatabaseManager method as a coroutine. All the calls are queued on a
+    # single dedicated thread, which owns the sqlite connection, so disk I/O never blocks
+    # the event loop and the connection is never shared between threads. The database is opened
+    # on first use, so a process that only imports the package, like a parser worker that
+    # imports the main script again, never opens it.
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+        self._db = None
+
+    def _open(self) -> DatabaseManager:
+        if self._db is None:
+            self._db = self._executor.submit(DatabaseManager, self.db_name).result()
+        return self._db
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._open(), name)
+        if not callable(attribute):
+            return attribute
+
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            # Includes the time spent waiting for the database thread
+            with DB_QUERY_DURATION.time(method=name):
+                return await loop.run_in_executor(self._executor, partial(attribute, *args, **kwargs))
+
+        method.__name__ = name
+        return method
+
+    def close(self):
+        if self._db is not None:
+            self._executor.submit(self._db.close).result()
+        self._executor.shutdown()
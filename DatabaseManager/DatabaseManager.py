@@ -1,7 +1,15 @@
+import json
 import sqlite3
-from typing import List, Dict, Any, Tuple, Optional
+from typing import List, Dict, Any, Sequence, Tuple, Optional
 from datetime import datetime
 
+# Marks an entry of a feed as handled, skipped when the feed was deleted in the meantime
+SEEN_ENTRY_QUERY = '''
+INSERT OR IGNORE INTO RssSeenEntry (server_id, url, entry_hash, timestamp)
+SELECT ?1, ?2, ?3, ?4
+WHERE EXISTS (SELECT 1 FROM RssFeed WHERE server_id = ?1 AND url = ?2)
+'''
+
 
 class DatabaseManager:
     def __init__(self, db_name: str):
@@ -14,10 +22,14 @@ class DatabaseManager:
 
     def connect(self):
         self.conn = sqlite3.connect(self.db_name)
-        self.conn.row_factory = self.row_to_dict
+        # Rows are read by column name like a dict, but built in C and read-only
+        self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
         # Enable foreign key support
         self.cursor.execute("PRAGMA foreign_keys = ON;")
+        # Let readers run alongside the writer and only fsync on checkpoints
+        self.cursor.execute("PRAGMA journal_mode = WAL;")
+        self.cursor.execute("PRAGMA synchronous = NORMAL;")
         self.conn.commit()
 
     def close(self):
@@ -33,10 +45,16 @@ class DatabaseManager:
             channel_name String NOT NULL,
             channel_id INTEGER NOT NULL,
             enabled BOOLEAN DEFAULT TRUE NOT NULL,
+            digest BOOLEAN DEFAULT FALSE NOT NULL,
             PRIMARY KEY (server_id, url)
         )
         ''')
 
+        # Databases created before the digest mode
+        self.cursor.execute("PRAGMA table_info(RssFeed)")
+        if 'digest' not in [column['name'] for column in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE RssFeed ADD COLUMN digest BOOLEAN DEFAULT FALSE NOT NULL")
+
         self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS RssHistory(
             server_id INTEGER NOT NULL,
@@ -48,6 +66,101 @@ class DatabaseManager:
         )
         ''')
 
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS RssHistory_server_url_timestamp ON RssHistory(server_id, url, timestamp)
+        ''')
+
+        # The feeds of a guild are listed a page at a time by name
+        self.cursor.execute('''
+        CREATE INDEX IF NOT EXISTS RssFeed_server_name_url ON RssFeed(server_id, name, url)
+        ''')
+
+        # High-water mark of the newest history entry of every feed, kept in sync by add_rss_history_many
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS RssFeedState(
+            server_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            timestamp DATETIME NOT NULL,
+            FOREIGN KEY (server_id, url) REFERENCES RssFeed(server_id, url) ON DELETE CASCADE ON UPDATE CASCADE,
+            PRIMARY KEY (server_id, url)
+        )
+        ''')
+
+        # Hashes of the GUID or link of every entry handled per feed, used to detect new entries
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS RssSeenEntry(
+            server_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            entry_hash INTEGER NOT NULL,
+            timestamp DATETIME NOT NULL,
+            FOREIGN KEY (server_id, url) REFERENCES RssFeed(server_id, url) ON DELETE CASCADE ON UPDATE CASCADE,
+            PRIMARY KEY (server_id, url, entry_hash)
+        ) WITHOUT ROWID
+        ''')
+
+        self.cursor.execute('''
+        INSERT OR IGNORE INTO RssFeedState (server_id, url, timestamp)
+        SELECT server_id, url, max(timestamp) FROM RssHistory GROUP BY server_id, url
+        ''')
+
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS FeedCache(
+            url TEXT NOT NULL,
+            etag TEXT,
+            modified TEXT,
+            PRIMARY KEY (url)
+        )
+        ''')
+
+        # Log of the changed feeds, filled by the triggers below whichever process writes RssFeed.
+        # The id is the version of the feeds, a process holding them in memory reads the rows
+        # changed since its version instead of all the feeds again.
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS RssFeedChange(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            timestamp TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS RssFeed_insert AFTER INSERT ON RssFeed BEGIN
+            INSERT INTO RssFeedChange (server_id, url) VALUES (NEW.server_id, NEW.url);
+        END
+        ''')
+
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS RssFeed_update AFTER UPDATE ON RssFeed BEGIN
+            INSERT INTO RssFeedChange (server_id, url) VALUES (OLD.server_id, OLD.url);
+            INSERT INTO RssFeedChange (server_id, url) SELECT NEW.server_id, NEW.url
+            WHERE NEW.server_id != OLD.server_id OR NEW.url != OLD.url;
+        END
+        ''')
+
+        self.cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS RssFeed_delete AFTER DELETE ON RssFeed BEGIN
+            INSERT INTO RssFeedChange (server_id, url) VALUES (OLD.server_id, OLD.url);
+        END
+        ''')
+
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS PendingDelivery(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER NOT NULL,
+            delivery TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+        ''')
+
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS FeedWorker(
+            worker_index INTEGER NOT NULL,
+            heartbeat TEXT NOT NULL,
+            PRIMARY KEY (worker_index)
+        )
+        ''')
+
         self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS MainChannel(
             server_id INTEGER NOT NULL,
@@ -67,12 +180,6 @@ class DatabaseManager:
         ''')
         self.conn.commit()
 
-    def row_to_dict(self, cursor: sqlite3.Cursor, row: sqlite3.Row) -> dict:
-        data = {}
-        for idx, col in enumerate(cursor.description):
-            data[col[0]] = row[idx]
-        return data
-
     def insert(self, table: str, data: Dict[str, Any]):
         columns = ', '.join(data.keys())
         placeholders = ', '.join(['?' for _ in data])
@@ -81,17 +188,19 @@ class DatabaseManager:
         self.cursor.execute(query, tuple(data.values()))
         self.conn.commit()
 
-    def update(self, table: str, data: Dict[str, Any], condition: str):
+    # The conditions take ? placeholders bound to params, so a query is the same statement on every
+    # call and sqlite3 reuses its prepared statement instead of parsing it again
+    def update(self, table: str, data: Dict[str, Any], condition: str, params: Sequence[Any] = ()):
         set_clause = ', '.join([f"{key} = ?" for key in data.keys()])
         query = f"UPDATE {table} SET {set_clause} WHERE {condition}"
         # print(query)
-        self.cursor.execute(query, tuple(data.values()))
+        self.cursor.execute(query, (*data.values(), *params))
         self.conn.commit()
 
-    def delete(self, table: str, condition: str):
+    def delete(self, table: str, condition: str, params: Sequence[Any] = ()):
         query = f"DELETE FROM {table} WHERE {condition}"
         # print(query)
-        self.cursor.execute(query)
+        self.cursor.execute(query, tuple(params))
         self.conn.commit()
 
     def select(self,
@@ -101,7 +210,8 @@ class DatabaseManager:
                where_condition: str = None,
                order_by: List[str] = None,
                group_by: List[str] = None,
-               limit: int = None) -> List[Tuple]:
+               limit: int = None,
+               params: Sequence[Any] = ()) -> List[Tuple]:
         columns_str = '*' if columns is None else ', '.join(columns)
         query = f"SELECT {columns_str} FROM {tables[0]}"
 
@@ -124,21 +234,24 @@ class DatabaseManager:
 
         # Handle LIMIT clause
         if limit:
-            query += f" LIMIT {limit}"
+            query += " LIMIT ?"
+            params = (*params, limit)
 
         # print(query)
-        self.cursor.execute(query)
+        self.cursor.execute(query, tuple(params))
         return self.cursor.fetchall()
 
     # ADD HANDLERS
-    def add_rss_feed(self, server_id: int, name: str, url: str, channel_name: str, channel_id: int, enabled: bool = True):
+    def add_rss_feed(self, server_id: int, name: str, url: str, channel_name: str, channel_id: int, enabled: bool = True,
+                     digest: bool = False):
         data = {
             'server_id': server_id,
             'name': name,
             'url': url,
             'channel_name': channel_name,
             'channel_id': channel_id,
-            'enabled': enabled
+            'enabled': enabled,
+            'digest': digest
         }
         self.insert('RssFeed', data)
 
@@ -153,6 +266,46 @@ class DatabaseManager:
         }
         self.insert('RssHistory', data)
 
+    def add_rss_history_many(self, rows: List[Tuple[int, str, str, str]], seen_rows: List[Tuple[int, str, int, str]] = ()):
+        # rows of (server_id, url, title, timestamp) and seen_rows of (server_id, url, entry_hash, timestamp),
+        # written in one transaction. Rows of feeds deleted in the meantime are skipped instead of failing
+        # the foreign key.
+        query = '''
+        INSERT INTO RssHistory (server_id, url, title, timestamp)
+        SELECT ?1, ?2, ?3, ?4
+        WHERE EXISTS (SELECT 1 FROM RssFeed WHERE server_id = ?1 AND url = ?2)
+        ON CONFLICT (server_id, url, title) DO UPDATE SET timestamp = excluded.timestamp
+        '''
+        state_query = '''
+        INSERT INTO RssFeedState (server_id, url, timestamp)
+        SELECT ?1, ?2, ?4
+        WHERE EXISTS (SELECT 1 FROM RssFeed WHERE server_id = ?1 AND url = ?2)
+        ON CONFLICT (server_id, url) DO UPDATE SET timestamp = max(timestamp, excluded.timestamp)
+        '''
+        with self.conn:
+            self.cursor.executemany(query, rows)
+            self.cursor.executemany(state_query, rows)
+            self.cursor.executemany(SEEN_ENTRY_QUERY, seen_rows)
+
+    def add_pending_deliveries(self, rows: List[Tuple[int, str, str]], seen_rows: List[Tuple[int, str, int, str]] = ()):
+        # rows of (server_id, delivery, timestamp), queued in the same transaction that marks their
+        # entries as seen so a restarted fetcher neither loses nor repeats them
+        query = "INSERT INTO PendingDelivery (server_id, delivery, timestamp) VALUES (?, ?, ?)"
+        with self.conn:
+            self.cursor.executemany(query, rows)
+            self.cursor.executemany(SEEN_ENTRY_QUERY, seen_rows)
+
+    def add_rss_feeds(self, feeds: List[Dict[str, Any]]) -> int:
+        # Bulk import in one transaction, feeds the guild already has are skipped.
+        # Returns the number of feeds added.
+        query = '''
+        INSERT OR IGNORE INTO RssFeed (server_id, name, url, channel_name, channel_id, enabled, digest)
+        VALUES (:server_id, :name, :url, :channel_name, :channel_id, :enabled, :digest)
+        '''
+        with self.conn:
+            self.cursor.executemany(query, feeds)
+            return self.cursor.rowcount
+
     def add_main_channel(self, server_id: int, channel_id: int):
         data = {
             'server_id': server_id,
@@ -168,60 +321,170 @@ class DatabaseManager:
         self.insert('AcceptedRole', data)
 
     # UPDATE HANDLERS
+    def set_feed_worker_heartbeat(self, worker_index: int, heartbeat: str):
+        query = '''
+        INSERT INTO FeedWorker (worker_index, heartbeat) VALUES (?, ?)
+        ON CONFLICT (worker_index) DO UPDATE SET heartbeat = excluded.heartbeat
+        '''
+        with self.conn:
+            self.cursor.execute(query, (worker_index, heartbeat))
+
     def update_rss_feed(self, server_id: int, url: str, data: Dict[str, Any]):
-        condition = f"server_id = {server_id} AND url = '{url}'"
-        self.update('RssFeed', data, condition)
+        self.update('RssFeed', data, "server_id = ? AND url = ?", (server_id, url))
+
+    def update_rss_feed_by_name(self, server_id: int, name: str, data: Dict[str, Any]):
+        self.update('RssFeed', data, "server_id = ? AND name = ?", (server_id, name))
 
     def update_rss_history(self, server_id: int, url: str, title: str, data: Dict[str, Any]):
-        condition = f"server_id = {server_id} AND url = '{url}' AND title = '{title}'"
-        self.update('RssHistory', data, condition)
+        self.update('RssHistory', data, "server_id = ? AND url = ? AND title = ?", (server_id, url, title))
+
+    def set_feed_cache(self, url: str, etag: str = None, modified: str = None):
+        query = '''
+        INSERT INTO FeedCache (url, etag, modified) VALUES (?, ?, ?)
+        ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, modified = excluded.modified
+        '''
+        with self.conn:
+            self.cursor.execute(query, (url, etag, modified))
 
     def update_main_channel(self, server_id: int, data: Dict[str, Any]):
-        condition = f"server_id = {server_id}"
-        self.update('MainChannel', data, condition)
+        self.update('MainChannel', data, "server_id = ?", (server_id,))
 
     def update_accepted_role(self, server_id: int, data: Dict[str, Any]):
-        condition = f"server_id = {server_id}"
-        self.update('AcceptedRole', data, condition)
+        self.update('AcceptedRole', data, "server_id = ?", (server_id,))
 
     # DELETE HANDLERS
     def delete_rss_feed(self, server_id: int, url: str):
-        condition = f"server_id = {server_id} AND url = '{url}'"
-        self.delete('RssFeed', condition)
+        self.delete('RssFeed', "server_id = ? AND url = ?", (server_id, url))
+
+    def delete_rss_feeds(self, server_id: int, urls: List[str]):
+        # The URLs are bound as a single JSON array, so any number of them is the same statement
+        self.delete('RssFeed', "server_id = ? AND url IN (SELECT value FROM json_each(?))",
+                    (server_id, json.dumps(urls)))
 
     def delete_rss_history(self, server_id: int, url: str, title: str):
-        condition = f"server_id = {server_id} AND url = '{url}' AND title = '{title}'"
-        self.delete('RssHistory', condition)
+        self.delete('RssHistory', "server_id = ? AND url = ? AND title = ?", (server_id, url, title))
 
     def scheduled_delete_rss_history(self):
         # delete history records older than 1 month
-        condition = f'timestamp < datetime(\'now\', \'-1 month\')'
-        self.delete('RssHistory', condition)
+        condition = "timestamp < datetime('now', ?)"
+        self.delete('RssHistory', condition, ('-1 month',))
+        # entries older than a month are never posted again, keep their hashes a while longer
+        # for the entries without a date
+        self.delete('RssSeenEntry', condition, ('-3 month',))
+        # deliveries nobody picked up in a day, e.g. for a guild the bot left
+        self.delete('PendingDelivery', condition, ('-1 day',))
+        # every process reads the changes of the feeds within a tick. The latest change is kept, so a
+        # process that missed deleted changes finds a gap in the ids and reads all the feeds again.
+        self.delete('RssFeedChange', condition + " AND id < (SELECT MAX(id) FROM RssFeedChange)", ('-1 day',))
+
+    def delete_pending_deliveries(self, ids: List[int]):
+        with self.conn:
+            self.cursor.executemany("DELETE FROM PendingDelivery WHERE id = ?", [(id_,) for id_ in ids])
 
     def delete_main_channel(self, server_id: int):
-        condition = f"server = {server_id}"
-        self.delete('MainChannel', condition)
+        self.delete('MainChannel', "server_id = ?", (server_id,))
 
     def delete_accepted_role(self, server_id: int):
-        condition = f"server_id = {server_id}"
-        self.delete('AcceptedRole', condition)
+        self.delete('AcceptedRole', "server_id = ?", (server_id,))
 
     # GET HANDLERS
     def get_rss_feeds(self, server_id: int = None) -> List[Tuple]:
-        where_condition = f"RssFeed.server_id = {server_id}" if server_id else None
-        return self.select(['RssFeed'], where_condition=where_condition)
+        if server_id:
+            return self.select(['RssFeed'], where_condition="RssFeed.server_id = ?", params=(server_id,))
+        return self.select(['RssFeed'])
+
+    def get_rss_feed_version(self) -> int:
+        # The id of the latest change of RssFeed, kept by sqlite_sequence even once the change is deleted
+        rows = self.select(['sqlite_sequence'], columns=['seq'], where_condition="name = ?",
+                           params=('RssFeedChange',))
+        return rows[0]['seq'] if rows else 0
+
+    def get_rss_feed_changes(self, version: int) -> List[Tuple]:
+        return self.select(['RssFeedChange'], where_condition="RssFeedChange.id > ?",
+                           order_by=['RssFeedChange.id'], params=(version,))
+
+    def get_rss_feeds_by_key(self, keys: List[Tuple[int, str]]) -> List[Tuple]:
+        # The (server_id, url) keys are bound as a single JSON array of pairs, every pair is a primary key lookup
+        return self.select(['json_each(?) AS key', 'RssFeed'],
+                           columns=['RssFeed.*'],
+                           join_conditions=["RssFeed.server_id = json_extract(key.value, '$[0]') "
+                                            "AND RssFeed.url = json_extract(key.value, '$[1]')"],
+                           params=(json.dumps(keys),))
+
+    def get_rss_feeds_page(self, server_id: int, after: Tuple[str, str] = None, before: Tuple[str, str] = None,
+                           limit: int = 25) -> List[Tuple]:
+        # Keyset pagination by (name, url): the page after or before the given key, read from the
+        # index, so every page costs the same however far into the list it is
+        if before is not None:
+            rows = self.select(['RssFeed'],
+                               where_condition="RssFeed.server_id = ? AND (RssFeed.name, RssFeed.url) < (?, ?)",
+                               order_by=['RssFeed.name DESC', 'RssFeed.url DESC'],
+                               limit=limit,
+                               params=(server_id, *before))
+            return rows[::-1]
+        if after is not None:
+            return self.select(['RssFeed'],
+                               where_condition="RssFeed.server_id = ? AND (RssFeed.name, RssFeed.url) > (?, ?)",
+                               order_by=['RssFeed.name', 'RssFeed.url'],
+                               limit=limit,
+                               params=(server_id, *after))
+        return self.select(['RssFeed'],
+                           where_condition="RssFeed.server_id = ?",
+                           order_by=['RssFeed.name', 'RssFeed.url'],
+                           limit=limit,
+                           params=(server_id,))
+
+    def count_rss_feeds(self, server_id: int) -> int:
+        return self.select(['RssFeed'], columns=['COUNT(*) AS count'],
+                           where_condition="RssFeed.server_id = ?", params=(server_id,))[0]['count']
 
     def get_rss_history(self, server_id: int, url: str) -> List[Tuple]:
-        where_condition = f"RssHistory.server_id = '{server_id}' AND RssHistory.url = '{url}'"
-        return self.select(['RssHistory'], where_condition=where_condition)
+        return self.select(['RssHistory'],
+                           where_condition="RssHistory.server_id = ? AND RssHistory.url = ?",
+                           params=(server_id, url))
+
+    def get_rss_history_timestamps(self, urls: List[str], limit: int = None) -> List[Tuple]:
+        return self.select(['RssHistory'],
+                           columns=['DISTINCT RssHistory.timestamp'],
+                           where_condition="RssHistory.url IN (SELECT value FROM json_each(?))",
+                           order_by=['RssHistory.timestamp DESC'],
+                           limit=limit,
+                           params=(json.dumps(urls),))
+
+    def get_rss_seen_entries(self, server_id: int, url: str) -> List[Tuple]:
+        return self.select(['RssSeenEntry'],
+                           columns=['entry_hash'],
+                           where_condition="RssSeenEntry.server_id = ? AND RssSeenEntry.url = ?",
+                           params=(server_id, url))
+
+    def get_rss_feed_states(self) -> List[Tuple]:
+        return self.select(['RssFeedState'])
+
+    def get_feed_caches(self, urls: List[str]) -> List[Tuple]:
+        return self.select(['FeedCache'], where_condition="FeedCache.url IN (SELECT value FROM json_each(?))",
+                           params=(json.dumps(urls),))
+
+    def get_pending_deliveries(self, after_id: int = 0, limit: int = None) -> List[Tuple]:
+        return self.select(['PendingDelivery'],
+                           where_condition="PendingDelivery.id > ?",
+                           order_by=['PendingDelivery.id ASC'],
+                           limit=limit,
+                           params=(after_id,))
+
+    def get_pending_delivery_ids(self, ids: List[int]) -> List[Tuple]:
+        return self.select(['PendingDelivery'],
+                           columns=['PendingDelivery.id'],
+                           where_condition="PendingDelivery.id IN (SELECT value FROM json_each(?))",
+                           params=(json.dumps(ids),))
+
+    def get_feed_workers(self, since: str) -> List[Tuple]:
+        return self.select(['FeedWorker'], where_condition="FeedWorker.heartbeat >= ?", params=(since,))
 
     def get_main_channel(self, server_id: int) -> List[Tuple]:
-        where_condition = f"MainChannel.server_id = {server_id}"
-        return self.select(['MainChannel'], where_condition=where_condition)
+        return self.select(['MainChannel'], where_condition="MainChannel.server_id = ?", params=(server_id,))
 
     def get_accepted_role(self, server_id: int) -> List[Tuple]:
-        where_condition = f"AcceptedRole.server_id = {server_id}"
-        return self.select(['AcceptedRole'], where_condition=where_condition)
+        return self.select(['AcceptedRole'], where_condition="AcceptedRole.server_id = ?", params=(server_id,))
 
     def get_rss_feeds_with_history(self, server_id: Optional[int] = None, limit: Optional[int] = None) -> List[Tuple]:
         tables = ['RssFeed', 'RssHistory']
@@ -230,7 +493,7 @@ class DatabaseManager:
             'RssHistory.title', 'RssHistory.timestamp'
         ]
         join_conditions = ['RssFeed.server_id = RssHistory.server_id AND RssFeed.url = RssHistory.url']
-        where_condition = f"RssFeed.server_id = {server_id}" if server_id else None
+        where_condition = "RssFeed.server_id = ?" if server_id else None
         order_by = ['RssHistory.timestamp DESC']
 
         return self.select(tables,
@@ -238,4 +501,5 @@ class DatabaseManager:
                            join_conditions=join_conditions,
                            where_condition=where_condition,
                            order_by=order_by,
-                           limit=limit)
+                           limit=limit,
+                           params=(server_id,) if server_id else ())
@@ -0,0 +1,107 @@
+from typing import Any, Dict, List, Optional
+
+
+class GuildConfigCache:
+    # Read-through cache of the configuration of every guild: the accepted role, the main channel
+    # and the number of RSS feeds, the feeds themselves are read a page at a time. Commands read
+    # it instead of the database, every change of the configuration goes through the write
+    # methods below so the cache is updated along with the database, and the subscription
+    # registry right after.
+    def __init__(self, db_manager, subscriptions):
+        self.db_manager = db_manager
+        self.subscriptions = subscriptions
+        self._accepted_roles: Dict[int, Optional[int]] = {}
+        self._main_channels: Dict[int, Optional[int]] = {}
+        self._rss_feed_counts: Dict[int, int] = {}
+        # Bumped on every write, a read that raced a write doesn't store what it read
+        self._generation = 0
+
+    def invalidate(self, server_id: int):
+        self._generation += 1
+        self._accepted_roles.pop(server_id, None)
+        self._main_channels.pop(server_id, None)
+        self._rss_feed_counts.pop(server_id, None)
+
+    async def rss_feeds_changed(self, server_id: int):
+        self._generation += 1
+        self._rss_feed_counts.pop(server_id, None)
+        await self.subscriptions.sync()
+
+    async def _load(self, cache: Dict, server_id: int, load):
+        if server_id in cache:
+            return cache[server_id]
+        generation = self._generation
+        value = await load()
+        if generation == self._generation:
+            cache[server_id] = value
+        return value
+
+    # READ HANDLERS
+    async def get_accepted_role(self, server_id: int) -> Optional[int]:
+        async def load():
+            rows = await self.db_manager.get_accepted_role(server_id)
+            return int(rows[0]['role_id']) if len(rows) == 1 else None
+        return await self._load(self._accepted_roles, server_id, load)
+
+    async def get_main_channel(self, server_id: int) -> Optional[int]:
+        async def load():
+            rows = await self.db_manager.get_main_channel(server_id)
+            return int(rows[0]['channel_id']) if len(rows) == 1 else None
+        return await self._load(self._main_channels, server_id, load)
+
+    async def count_rss_feeds(self, server_id: int) -> int:
+        async def load():
+            return await self.db_manager.count_rss_feeds(server_id)
+        return await self._load(self._rss_feed_counts, server_id, load)
+
+    # WRITE HANDLERS
+    async def add_main_channel(self, server_id: int, channel_id: int):
+        await self.db_manager.add_main_channel(server_id, channel_id)
+        self._generation += 1
+        self._main_channels[server_id] = channel_id
+
+    async def update_main_channel(self, server_id: int, channel_id: int):
+        await self.db_manager.update_main_channel(server_id, {'server_id': server_id, 'channel_id': channel_id})
+        # Nothing is updated when the guild has no row yet, read it again
+        self._generation += 1
+        self._main_channels.pop(server_id, None)
+
+    async def add_accepted_role(self, server_id: int, role_id: int):
+        await self.db_manager.add_accepted_role(server_id, role_id)
+        self._generation += 1
+        self._accepted_roles[server_id] = role_id
+
+    async def update_accepted_role(self, server_id: int, role_id: int):
+        await self.db_manager.update_accepted_role(server_id, {'server_id': server_id, 'role_id': role_id})
+        self._generation += 1
+        self._accepted_roles.pop(server_id, None)
+
+    async def add_rss_feed(self, server_id: int, **feed: Any):
+        try:
+            await self.db_manager.add_rss_feed(server_id=server_id, **feed)
+        finally:
+            await self.rss_feeds_changed(server_id)
+
+    async def add_rss_feeds(self, server_id: int, feeds: List[Dict[str, Any]]) -> int:
+        try:
+            return await self.db_manager.add_rss_feeds(feeds)
+        finally:
+            await self.rss_feeds_changed(server_id)
+
+    async def update_rss_feed(self, server_id: int, url: str, data: Dict[str, Any]):
+        try:
+            await self.db_manager.update_rss_feed(server_id, url, data)
+        finally:
+            await self.rss_feeds_changed(server_id)
+
+    async def update_rss_feed_by_name(self, server_id: int, name: str, data: Dict[str, Any]):
+        try:
+            await self.db_manager.update_rss_feed_by_name(server_id, name, data)
+        finally:
+            await self.rss_feeds_changed(server_id)
+
+    async def delete_rss_feeds(self, server_id: int, urls: List[str]):
+        try:
+            await self.db_manager.delete_rss_feeds(server_id, urls)
+        finally:
+            await self.rss_feeds_changed(server_id)
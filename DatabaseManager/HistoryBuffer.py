@@ -0,0 +1,56 @@
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import dateutil.parser as dt_parser
+
+
+class HistoryBuffer:
+    # Write-behind buffer for RssHistory, the rows collected during a tick are written
+    # by flush() in a single transaction instead of one commit per posted entry.
+    # It also keeps the newest timestamp of every feed in memory, mirroring RssFeedState.
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self._rows: List[Tuple] = []
+        self._seen_rows: List[Tuple] = []
+        self._high_water_marks: Dict[Tuple[int, str], datetime] = {}
+
+    async def load(self):
+        states = await self.db_manager.get_rss_feed_states()
+        self._high_water_marks = {(state['server_id'], state['url']): dt_parser.parse(state['timestamp'])
+                                  for state in states}
+
+    def last_seen(self, server_id: int, url: str) -> Optional[datetime]:
+        return self._high_water_marks.get((server_id, url))
+
+    def __len__(self):
+        return len(self._rows) + len(self._seen_rows)
+
+    def add(self, server_id: int, url: str, title: str, timestamp: datetime = None, entry_hash: int = None):
+        if timestamp is None:
+            timestamp = datetime.now()
+        self._rows.append((server_id, url, title, timestamp.isoformat()))
+        if entry_hash is not None:
+            self.mark_seen(server_id, url, entry_hash, timestamp)
+
+        key = (server_id, url)
+        if key not in self._high_water_marks or self._high_water_marks[key] < timestamp:
+            self._high_water_marks[key] = timestamp
+
+    def mark_seen(self, server_id: int, url: str, entry_hash: int, timestamp: datetime = None):
+        # Record an entry as handled without adding it to the history
+        if timestamp is None:
+            timestamp = datetime.now()
+        self._seen_rows.append((server_id, url, entry_hash, timestamp.isoformat()))
+
+    async def flush(self):
+        rows, self._rows = self._rows, []
+        seen_rows, self._seen_rows = self._seen_rows, []
+        if not rows and not seen_rows:
+            return
+        try:
+            await self.db_manager.add_rss_history_many(rows, seen_rows)
+        except Exception:
+            # Keep the rows for the next flush
+            self._rows[:0] = rows
+            self._seen_rows[:0] = seen_rows
+            raise
@@ -0,0 +1,35 @@
+from datetime import datetime
+from typing import List, Tuple
+
+
+class PendingDeliveryBuffer:
+    # Durable delivery queue of the standalone fetcher. The deliveries collected during a tick
+    # are written by flush() to PendingDelivery in a single transaction, together with their
+    # entries marked as seen, and the bot started with FETCH_MODE=external sends them.
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self._rows: List[Tuple] = []
+        self._seen_rows: List[Tuple] = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def put(self, delivery):
+        now = datetime.now()
+        self._rows.append((delivery.server_id, delivery.to_json(), now.isoformat()))
+        for entry in delivery.entries:
+            self._seen_rows.append((delivery.server_id, delivery.url, entry.entry_hash,
+                                    (entry.timestamp or now).isoformat()))
+
+    async def flush(self):
+        rows, self._rows = self._rows, []
+        seen_rows, self._seen_rows = self._seen_rows, []
+        if not rows and not seen_rows:
+            return
+        try:
+            await self.db_manager.add_pending_deliveries(rows, seen_rows)
+        except Exception:
+            # Keep the rows for the next flush
+            self._rows[:0] = rows
+            self._seen_rows[:0] = seen_rows
+            raise
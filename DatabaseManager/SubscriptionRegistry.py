@@ -0,0 +1,80 @@
+import asyncio
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+Key = Tuple[int, str]
+
+
+class SubscriptionRegistry:
+    # In-memory copy of RssFeed, read once and then kept up to date from the RssFeedChange log:
+    # sync() only reads the feeds changed since the last version it has seen, by this process
+    # or any other one sharing the database. Listeners are called with the key, the old row
+    # and the new row (None when the feed was deleted) of every feed that changed.
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self.version: Optional[int] = None
+        self._feeds: Dict[Key, Tuple] = {}
+        self._listeners: List[Callable[[Key, Optional[Tuple], Optional[Tuple]], None]] = []
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._feeds)
+
+    def get(self, server_id: int, url: str) -> Optional[Tuple]:
+        return self._feeds.get((server_id, url))
+
+    def values(self) -> List[Tuple]:
+        return list(self._feeds.values())
+
+    def add_listener(self, listener: Callable[[Key, Optional[Tuple], Optional[Tuple]], None]):
+        self._listeners.append(listener)
+
+    def _apply(self, key: Key, row: Optional[Tuple]):
+        old = self._feeds.get(key)
+        if row is None:
+            self._feeds.pop(key, None)
+        else:
+            self._feeds[key] = row
+        if old is not None or row is not None:
+            for listener in self._listeners:
+                # A listener failing on one feed must not keep the registry from moving past it
+                try:
+                    listener(key, old, row)
+                except Exception:
+                    print(f"Error applying the change of the RSS feed '{key[1]}' in server {key[0]}:")
+                    print(traceback.format_exc())
+
+    async def load(self):
+        async with self._lock:
+            await self._load()
+
+    async def _load(self):
+        # The version is read first, changes made while the feeds are read are read again by the next sync
+        version = await self.db_manager.get_rss_feed_version()
+        rows = {(row['server_id'], row['url']): row for row in await self.db_manager.get_rss_feeds()}
+        for key in set(self._feeds) - set(rows):
+            self._apply(key, None)
+        for key, row in rows.items():
+            if self._feeds.get(key) != row:
+                self._apply(key, row)
+        self.version = version
+
+    async def sync(self):
+        async with self._lock:
+            if self.version is None:
+                await self._load()
+                return
+
+            changes = await self.db_manager.get_rss_feed_changes(self.version)
+            if not changes:
+                return
+            if changes[0]['id'] != self.version + 1:
+                # Changes older than the log were deleted before they were read
+                await self._load()
+                return
+
+            keys = list({(change['server_id'], change['url']): None for change in changes})
+            rows = {(row['server_id'], row['url']): row for row in await self.db_manager.get_rss_feeds_by_key(keys)}
+            for key in keys:
+                self._apply(key, rows.get(key))
+            self.version = changes[-1]['id']
@@ -1,4 +1,13 @@
 from DatabaseManager.DatabaseManager import DatabaseManager
+from DatabaseManager.AsyncDatabaseManager import AsyncDatabaseManager
+from DatabaseManager.GuildConfigCache import GuildConfigCache
+from DatabaseManager.HistoryBuffer import HistoryBuffer
+from DatabaseManager.PendingDeliveryBuffer import PendingDeliveryBuffer
+from DatabaseManager.SubscriptionRegistry import SubscriptionRegistry
 
 # Initialize the database manager
-db_manager = DatabaseManager('sql.db')
+db_manager = AsyncDatabaseManager('sql.db')
+history_buffer = HistoryBuffer(db_manager)
+subscriptions = SubscriptionRegistry(db_manager)
+guild_config = GuildConfigCache(db_manager, subscriptions)
+
@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+from typing import List
+
+from benchmarks.feed_server import SyntheticFeeds, serve
+
+HOST = '127.0.0.1'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Runs the feed pipeline against local synthetic feeds and a fake Discord, fully offline.')
+    parser.add_argument('--feeds', type=int, default=200, help='distinct feeds served')
+    parser.add_argument('--subscribers', type=int, default=1, help='guilds subscribed to every feed')
+    parser.add_argument('--entries', type=int, default=20, help='entries in every feed')
+    parser.add_argument('--entry-size', type=int, default=200, help='bytes of text in every entry')
+    parser.add_argument('--change-rate', type=float, default=0.1, help='chance a feed has a new entry on a request')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the server waits before answering')
+    parser.add_argument('--atom-ratio', type=float, default=0.5, help='share of the feeds served as Atom')
+    parser.add_argument('--no-gzip', action='store_true', help='serve the feeds uncompressed')
+    parser.add_argument('--digest', action='store_true', help='subscribe in digest mode')
+    parser.add_argument('--send-latency', type=float, default=0.0, help='seconds a fake Discord send takes')
+    parser.add_argument('--throttle', action='store_true', help='keep the Discord rate limits of the delivery queue')
+    parser.add_argument('--ticks', type=int, default=10, help='ticks measured after the first, cold, one')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    return parser.parse_args()
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(percent / 100 * (len(values) - 1)))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+async def run(args, port: int):
+    # Imported here, the database is created in the current directory on import
+    import core.delivery
+    import core.fetcher
+    import core.pipeline
+    from DatabaseManager import db_manager, history_buffer, subscriptions
+    from benchmarks.fake_discord import FakeChannelRouter
+    from core.dedup import SeenEntries
+    from core.metrics import DB_QUERY_DURATION
+    from core.pipeline import FeedPipeline
+    from core.scheduler import FeedScheduler
+    from core.sharding import FeedPartition
+
+    if not args.throttle:
+        core.delivery.CHANNEL_RATE = core.delivery.GLOBAL_RATE = 1e9
+        core.delivery.CHANNEL_BURST = core.delivery.GLOBAL_BURST = 10 ** 9
+
+    channel_router = FakeChannelRouter(args.send_latency)
+    for feed in range(args.feeds):
+        url = f'http://{HOST}:{port}/feeds/{feed}'
+        for subscriber in range(args.subscribers):
+            channel_id = 1000 + feed * args.subscribers + subscriber
+            await db_manager.add_rss_feed(subscriber + 1, f'Feed {feed}', url, f'feed-{feed}', channel_id,
+                                          digest=args.digest)
+            channel_router.add_channel(channel_id, f'feed-{feed}')
+
+    seen_entries = SeenEntries(db_manager)
+    delivery_queue = core.delivery.DeliveryQueue(channel_router, history_buffer)
+    feed_pipeline = FeedPipeline(db_manager, history_buffer, seen_entries, delivery_queue, FeedPartition(db_manager),
+                                 subscriptions)
+    # Every feed is due on every tick
+    feed_pipeline.feed_scheduler = FeedScheduler(min_interval=0, max_interval=0)
+
+    results = []
+    fetch_feed = core.pipeline.fetch_feed
+
+    async def recorded_fetch_feed(*fetch_args, **fetch_kwargs):
+        result = await fetch_feed(*fetch_args, **fetch_kwargs)
+        results.append(result)
+        return result
+
+    core.pipeline.fetch_feed = recorded_fetch_feed
+
+    await history_buffer.load()
+    ticks = []
+    for _ in range(args.ticks + 1):
+        results.clear()
+        db_calls = DB_QUERY_DURATION.count()
+        start = time.perf_counter()
+        await feed_pipeline.tick()
+        ticks.append({
+            'duration': time.perf_counter() - start,
+            'db_calls': DB_QUERY_DURATION.count() - db_calls,
+            'latencies': [result.elapsed for result in results],
+            'not_modified': sum(result.status == 304 for result in results),
+            'errors': sum(result.error is not None for result in results),
+        })
+
+    start = time.perf_counter()
+    await delivery_queue.join()
+    await history_buffer.flush()
+    drain = time.perf_counter() - start
+    await core.fetcher.close()
+
+    cold, steady = ticks[0], ticks[1:]
+    latencies = [latency for tick in steady for latency in tick['latencies']]
+    durations = [tick['duration'] for tick in steady]
+    fetches = len(latencies)
+    return {
+        'feeds': args.feeds,
+        'subscriptions': args.feeds * args.subscribers,
+        'cold_tick_seconds': cold['duration'],
+        'ticks': len(steady),
+        'ticks_per_second': len(steady) / sum(durations) if durations else 0.0,
+        'tick_p50_seconds': percentile(durations, 50),
+        'tick_p99_seconds': percentile(durations, 99),
+        'fetch_p50_seconds': percentile(latencies, 50),
+        'fetch_p99_seconds': percentile(latencies, 99),
+        'not_modified_ratio': sum(tick['not_modified'] for tick in steady) / fetches if fetches else 0.0,
+        'fetch_errors': sum(tick['errors'] for tick in ticks),
+        'db_calls_per_tick': sum(tick['db_calls'] for tick in steady) / len(steady) if steady else 0.0,
+        'messages_sent': channel_router.messages(),
+        'drain_seconds': drain,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    args = parse_args()
+    port = free_port()
+    feeds = SyntheticFeeds(args.feeds, args.entries, args.entry_size, args.change_rate, args.latency,
+                           args.atom_ratio, not args.no_gzip, args.seed)
+    server = multiprocessing.Process(target=serve, args=(feeds, HOST, port), daemon=True)
+    server.start()
+    try:
+        wait_for_port(port)
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            report = asyncio.run(run(args, port))
+    finally:
+        server.terminate()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for name, value in report.items():
+        print(f'{name:<22} {value:.4f}' if isinstance(value, float) else f'{name:<22} {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import asyncio
+from typing import Dict, Optional
+
+
+class FakeChannel:
+    # Stands in for a discord.TextChannel, send() only counts the messages
+    def __init__(self, channel_id: int, name: str, latency: float = 0.0):
+        self.id = channel_id
+        self.name = name
+        self.latency = latency
+        self.messages = 0
+        self.embeds = 0
+
+    async def send(self, content: str = None, embeds=None, silent: bool = False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.messages += 1
+        self.embeds += len(embeds or ())
+
+
+class FakeChannelRouter:
+    # Stands in for core.routing.ChannelRouter, every guild is local and every channel exists
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.channels: Dict[int, FakeChannel] = {}
+
+    def add_channel(self, channel_id: int, name: str) -> FakeChannel:
+        channel = self.channels[channel_id] = FakeChannel(channel_id, name, self.latency)
+        return channel
+
+    def is_local(self, server_id: int) -> bool:
+        return True
+
+    async def resolve(self, server_id: int, url: str, channel_id: int, channel_name: str) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    def messages(self) -> int:
+        return sum(channel.messages for channel in self.channels.values())
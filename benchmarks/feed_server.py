@@ -0,0 +1,101 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import List
+
+from aiohttp import web
+
+
+class SyntheticFeeds:
+    # Serves /feeds/<n> as RSS 2.0, or Atom for a share of the feeds. On every request a feed
+    # gets a new entry with probability change_rate, unchanged feeds answer 304 to their ETag.
+    def __init__(self,
+                 count: int,
+                 entries: int = 20,
+                 entry_size: int = 200,
+                 change_rate: float = 0.1,
+                 latency: float = 0.0,
+                 atom_ratio: float = 0.5,
+                 gzip: bool = True,
+                 seed: int = 0):
+        self.count = count
+        self.entries = entries
+        self.entry_size = entry_size
+        self.change_rate = change_rate
+        self.latency = latency
+        self.atom_ratio = atom_ratio
+        self.gzip = gzip
+        self.random = random.Random(seed)
+        self.versions: List[int] = [entries] * count
+        # Entry i of a feed was published i minutes after start, so they are all recent
+        self.start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(minutes=entries)
+
+    def _published(self, number: int) -> datetime:
+        return self.start + timedelta(minutes=number)
+
+    def _rss(self, feed: int, version: int) -> str:
+        items = []
+        for number in range(version, max(version - self.entries, 0), -1):
+            items.append(f'''<item>
+<title>Feed {feed} entry {number}</title>
+<link>https://feeds.example.com/{feed}/{number}</link>
+<guid>feed-{feed}-{number}</guid>
+<pubDate>{format_datetime(self._published(number))}</pubDate>
+<description>{'x' * self.entry_size}</description>
+</item>''')
+        return f'''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel>
+<title>Feed {feed}</title>
+<link>https://feeds.example.com/{feed}</link>
+{''.join(items)}
+</channel></rss>'''
+
+    def _atom(self, feed: int, version: int) -> str:
+        entries = []
+        for number in range(version, max(version - self.entries, 0), -1):
+            entries.append(f'''<entry>
+<title>Feed {feed} entry {number}</title>
+<link href="https://feeds.example.com/{feed}/{number}"/>
+<id>feed-{feed}-{number}</id>
+<updated>{self._published(number).isoformat()}</updated>
+<summary>{'x' * self.entry_size}</summary>
+</entry>''')
+        return f'''<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>Feed {feed}</title>
+{''.join(entries)}
+</feed>'''
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        feed = int(request.match_info['feed'])
+        if not 0 <= feed < self.count:
+            raise web.HTTPNotFound()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.random.random() < self.change_rate:
+            self.versions[feed] += 1
+        version = self.versions[feed]
+        etag = f'"{feed}-{version}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+
+        atom = feed < self.count * self.atom_ratio
+        body = self._atom(feed, version) if atom else self._rss(feed, version)
+        response = web.Response(text=body,
+                                content_type='application/atom+xml' if atom else 'application/rss+xml',
+                                headers={'ETag': etag})
+        if self.gzip:
+            response.enable_compression()
+        return response
+
+    def url(self, host: str, port: int, feed: int) -> str:
+        return f'http://{host}:{port}/feeds/{feed}'
+
+
+def serve(feeds: SyntheticFeeds, host: str, port: int):
+    # Runs in its own process, so serving the feeds doesn't compete with the measured pipeline
+    app = web.Application()
+    app.router.add_get('/feeds/{feed}', feeds.handle)
+    web.run_app(app, host=host, port=port, print=None, access_log=None)
@@ -13,3 +13,39 @@ MESSAGES = {
 }
 
 TOKEN = os.getenv('TOKEN')
+
+# Feed fetching limits
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 32))
+FETCH_PER_HOST_CONCURRENCY = int(os.getenv('FETCH_PER_HOST_CONCURRENCY', 4))
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 30))
+FETCH_CONNECT_TIMEOUT = float(os.getenv('FETCH_CONNECT_TIMEOUT', 10))
+# Seconds a resolved host name is reused by the feed HTTP client
+FETCH_DNS_CACHE_TTL = int(os.getenv('FETCH_DNS_CACHE_TTL', 300))
+# Upper bounds of a single feed, larger feeds are cut at the limit
+MAX_FEED_BYTES = int(os.getenv('MAX_FEED_BYTES', 16 * 1024 * 1024))
+MAX_FEED_ENTRIES = int(os.getenv('MAX_FEED_ENTRIES', 500))
+# Worker processes parsing the downloaded feeds, 0 parses them in the fetch threads while they download
+PARSER_PROCESSES = int(os.getenv('PARSER_PROCESSES', 0))
+
+# Feed polling, every feed is polled between the min and max interval (in seconds)
+# depending on how often it publishes
+POLL_MIN_INTERVAL = float(os.getenv('POLL_MIN_INTERVAL', 60))
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', 3600))
+SCHEDULER_TICK = float(os.getenv('SCHEDULER_TICK', 15))
+
+# Local HTTP endpoint serving the Prometheus metrics on /metrics, disabled when the port is 0
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# With FETCH_MODE=external the feeds are fetched by the standalone fetcher (python -m fetcher)
+# and the bot only sends the entries it queued, checking for them every DELIVERY_POLL_INTERVAL seconds
+FETCH_MODE = os.getenv('FETCH_MODE', 'internal')
+DELIVERY_POLL_INTERVAL = float(os.getenv('DELIVERY_POLL_INTERVAL', 2))
+
+# Sharded mode, CLUSTER_SIZE processes share the gateway shards and the feeds. Every process
+# gets its own CLUSTER_INDEX, from 0 to CLUSTER_SIZE - 1, and they all use the same database.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+CLUSTER_SIZE = int(os.getenv('CLUSTER_SIZE', 1))
+CLUSTER_INDEX = int(os.getenv('CLUSTER_INDEX', 0))
+# Seconds without a heartbeat before the feeds of a process are taken over by the others
+CLUSTER_HEARTBEAT_TIMEOUT = float(os.getenv('CLUSTER_HEARTBEAT_TIMEOUT', 60))
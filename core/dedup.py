@@ -0,0 +1,30 @@
+import hashlib
+from typing import Dict, Set, Tuple
+
+
+def entry_hash(entry) -> int:
+    # Fixed-width identity of a ParsedEntry: its GUID, or its link when the feed has no GUIDs.
+    # Stored as a signed 64-bit integer so it fits a sqlite INTEGER column.
+    key = entry.id or entry.link or entry.title or ''
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class SeenEntries:
+    # Hashes of the entries already handled for every feed, loaded lazily from RssSeenEntry
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self._seen: Dict[Tuple[int, str], Set[int]] = {}
+
+    async def get(self, server_id: int, url: str) -> Set[int]:
+        key = (server_id, url)
+        if key not in self._seen:
+            rows = await self.db_manager.get_rss_seen_entries(server_id, url)
+            self._seen[key] = {row['entry_hash'] for row in rows}
+        return self._seen[key]
+
+    def forget(self, server_id: int, url: str):
+        self._seen.pop((server_id, url), None)
+
+    def clear(self):
+        self._seen.clear()
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import dateutil.parser as dt_parser
+
+from core.fetcher import is_valid_url
+from core.metrics import ENTRIES_POSTED
+
+import discord
+
+# Discord allows 5 messages per 5 seconds in a channel and 50 requests per second globally
+CHANNEL_RATE = 1.0
+CHANNEL_BURST = 5
+GLOBAL_RATE = 50.0
+GLOBAL_BURST = 50
+MAX_RETRIES = 3
+# Seconds before a delivery whose retries all failed is queued again, and how many times it is
+RETRY_DELAY = 300
+MAX_REQUEUES = 12
+# A message holds at most 10 embeds
+DIGEST_SIZE = 10
+# Deliveries read at once from the queue of the standalone fetcher
+PENDING_BATCH = 500
+
+
+class DeliveryEntry(NamedTuple):
+    title: str
+    link: str
+    timestamp: Optional[datetime]
+    entry_hash: int
+
+
+class Delivery(NamedTuple):
+    server_id: int
+    url: str
+    channel_id: int
+    channel_name: str
+    feed_title: str
+    entries: Tuple[DeliveryEntry, ...]
+    digest: bool = False
+    # Row of the delivery in PendingDelivery when it was queued by the standalone fetcher
+    pending_id: Optional[int] = None
+    # Times the delivery was queued again after all its retries failed
+    requeues: int = 0
+
+    def message(self) -> Dict:
+        # A digest sends up to DIGEST_SIZE entries as embeds of a single message
+        if not self.digest:
+            return {'content': f"**{self.feed_title}**\n{self.entries[0].link}\n"}
+        embeds = [discord.Embed(title=entry.title[:256],
+                                url=entry.link if is_valid_url(entry.link or '') else None,
+                                timestamp=entry.timestamp.replace(tzinfo=timezone.utc) if entry.timestamp else None)
+                  for entry in self.entries]
+        return {'content': f"**{self.feed_title}**"[:2000], 'embeds': embeds}
+
+    def to_json(self) -> str:
+        data = self._asdict()
+        data.pop('pending_id')
+        data.pop('requeues')
+        data['entries'] = [[entry.title, entry.link, entry.timestamp.isoformat() if entry.timestamp else None,
+                            entry.entry_hash] for entry in self.entries]
+        return json.dumps(data)
+
+    @classmethod
+    def from_json(cls, data: str, pending_id: Optional[int] = None) -> 'Delivery':
+        data = json.loads(data)
+        data['entries'] = tuple(DeliveryEntry(title, link, dt_parser.isoparse(timestamp) if timestamp else None, hash_)
+                                for title, link, timestamp, hash_ in data['entries'])
+        return cls(**data, pending_id=pending_id)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class DeliveryQueue:
+    # Sends the new entries found by the fetch loop. Every channel has its own queue, drained
+    # by its own worker under the channel rate limit, so a backlog in one channel never holds
+    # back the others. A worker exits as soon as its queue is empty.
+    def __init__(self, channel_router, history_buffer):
+        self.channel_router = channel_router
+        self.history_buffer = history_buffer
+        self._global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        # Rows of PendingDelivery already handled, the ones to send again and the last row read
+        self._pending_done: List[int] = []
+        self._pending_retry: List[Delivery] = []
+        self._pending_id = 0
+
+    def qsize(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def join(self):
+        # Wait until every queued delivery was handled
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    def put(self, delivery: Delivery):
+        queue = self._queues.get(delivery.channel_id)
+        if queue is None:
+            queue = self._queues[delivery.channel_id] = asyncio.Queue()
+            self._workers[delivery.channel_id] = asyncio.create_task(self._work(delivery.channel_id, queue))
+        queue.put_nowait(delivery)
+
+    async def _work(self, channel_id: int, queue: asyncio.Queue):
+        bucket = self._buckets.setdefault(channel_id, TokenBucket(CHANNEL_RATE, CHANNEL_BURST))
+        try:
+            while not queue.empty():
+                delivery = queue.get_nowait()
+                handled = True
+                try:
+                    handled = await self._deliver(delivery, bucket)
+                except Exception:
+                    print(f"Error sending the RSS feed:")
+                    print(traceback.format_exc())
+                if not handled and delivery.requeues >= MAX_REQUEUES:
+                    print(f"Giving up sending the RSS feed '{delivery.url}' to channel '{delivery.channel_name}'")
+                    handled = True
+                if delivery.pending_id is None:
+                    # Its entries stay seen, a conditional poll of the feed would not find them again
+                    if not handled:
+                        asyncio.get_running_loop().call_later(
+                            RETRY_DELAY, self.put, delivery._replace(requeues=delivery.requeues + 1))
+                    continue
+                # The row of a delivery that may still go through is kept and sent again by a later drain
+                if handled:
+                    self._pending_done.append(delivery.pending_id)
+                else:
+                    asyncio.get_running_loop().call_later(
+                        RETRY_DELAY, self._pending_retry.append, delivery._replace(requeues=delivery.requeues + 1))
+        finally:
+            del self._queues[channel_id]
+            del self._workers[channel_id]
+
+    async def _deliver(self, delivery: Delivery, bucket: TokenBucket) -> bool:
+        # False when every attempt failed with an error that may not happen again
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(2 ** attempt)
+
+            channel = await self.channel_router.resolve(
+                delivery.server_id, delivery.url, delivery.channel_id, delivery.channel_name)
+            if channel is None:
+                print(f"Channel {delivery.channel_name} for feed {delivery.url} not found!")
+                return True
+
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                await channel.send(**delivery.message(), silent=True)
+            except discord.Forbidden:
+                print(f"Missing permissions to send the RSS feed to channel '{delivery.channel_name}'")
+                return True
+            except (discord.HTTPException, OSError, asyncio.TimeoutError) as error:
+                print(f"Error sending the RSS feed to channel '{delivery.channel_name}' (attempt {attempt + 1}): {error!r}")
+                # Apart from rate limits, a request refused by Discord is refused again
+                if isinstance(error, discord.HTTPException) and 400 <= error.status < 500 and error.status != 429:
+                    return True
+                continue
+
+            ENTRIES_POSTED.inc(len(delivery.entries), server_id=delivery.server_id)
+            for entry in delivery.entries:
+                self.history_buffer.add(delivery.server_id, delivery.url, entry.title,
+                                        entry.timestamp, entry.entry_hash)
+            return True
+        return False
+
+    async def drain_pending(self, db_manager):
+        # Moves the deliveries queued by the standalone fetcher into the channel queues. A row is
+        # deleted once it was sent or can never be, so the rows still queued at a restart are sent again.
+        # The lists are only emptied once the database was updated, a failed drain is done again.
+        done = list(self._pending_done)
+        if done:
+            await db_manager.delete_pending_deliveries(done)
+            del self._pending_done[:len(done)]
+
+        retry = list(self._pending_retry)
+        if retry:
+            # Rows deleted by the cleanup in the meantime aren't sent
+            rows = await db_manager.get_pending_delivery_ids([delivery.pending_id for delivery in retry])
+            del self._pending_retry[:len(retry)]
+            ids = {row['id'] for row in rows}
+            for delivery in retry:
+                if delivery.pending_id in ids:
+                    self.put(delivery)
+
+        for row in await db_manager.get_pending_deliveries(self._pending_id, limit=PENDING_BATCH):
+            self._pending_id = row['id']
+            # The guilds of the other processes of a cluster are drained by them
+            if self.channel_router.is_local(row['server_id']):
+                self.put(Delivery.from_json(row['delivery'], row['id']))
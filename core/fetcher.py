@@ -0,0 +1,241 @@
+import asyncio
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, FrozenSet, NamedTuple, Optional
+from urllib.parse import urlsplit, urlunsplit
+from xml.etree import ElementTree
+
+import aiohttp
+import feedparser
+
+from core.constants import FETCH_CONCURRENCY, FETCH_CONNECT_TIMEOUT, FETCH_DNS_CACHE_TTL, \
+    FETCH_PER_HOST_CONCURRENCY, FETCH_TIMEOUT, MAX_FEED_BYTES, PARSER_PROCESSES
+from core.metrics import FEED_FETCH_SECONDS, FETCH_BYTES, FETCH_DURATION, FETCHES, PARSE_DURATION
+from core.parser import ParsedFeed, StreamingFeedParser, from_feedparser, parse_feed
+
+USER_AGENT = f'discord-rss-feeder {feedparser.USER_AGENT}'
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchResult(NamedTuple):
+    url: str
+    status: Optional[int] = None
+    headers: Dict[str, str] = {}
+    feed: Optional[ParsedFeed] = None
+    error: Optional[BaseException] = None
+    elapsed: float = 0.0
+
+
+# Streaming parses run in a dedicated pool sized to the global limit, so the
+# default executor used by the rest of the bot is never starved by large feeds
+_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix='rss-parse')
+# With PARSER_PROCESSES set the feeds are parsed in worker processes instead, away from
+# the GIL of the event loop, created on the first fetch
+_parser_pool = None
+# One HTTP client for every feed, created on the first fetch. Connections are kept alive and
+# reused between polls.
+_session = None
+# The global and per-host limits. They are acquired before the timeout of a fetch starts, so
+# feeds waiting for their turn don't time out before they are even requested.
+_global_limit = None
+_host_limits = defaultdict(lambda: asyncio.Semaphore(FETCH_PER_HOST_CONCURRENCY))
+
+
+def is_valid_url(url: str) -> bool:
+    # An http(s) URL with a host and, if any, a numeric port
+    try:
+        parts = urlsplit(url.strip())
+        parts.port
+    except ValueError:
+        return False
+    return parts.scheme.lower() in ('http', 'https') and bool(parts.hostname)
+
+
+def normalize_url(url: str) -> str:
+    # Subscriptions that only differ in casing, default port or fragment share one fetch
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        # A bad port or IPv6 host, left as is, the fetch reports the error
+        return url.strip()
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if port and (scheme, port) not in (('http', 80), ('https', 443)):
+        netloc += f':{port}'
+    if parts.username:
+        credentials = parts.username + (f':{parts.password}' if parts.password else '')
+        netloc = f'{credentials}@{netloc}'
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=FETCH_CONCURRENCY,
+                                         limit_per_host=FETCH_PER_HOST_CONCURRENCY,
+                                         ttl_dns_cache=FETCH_DNS_CACHE_TTL)
+        # The whole fetch is bounded by fetch_feed, these bound the single steps. Bodies are
+        # decompressed by aiohttp, which asks for brotli as the Brotli package is installed.
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=FETCH_CONNECT_TIMEOUT, sock_read=FETCH_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                         headers={'User-Agent': USER_AGENT}, auto_decompress=True)
+    return _session
+
+
+async def close():
+    global _session, _parser_pool
+    if _session is not None:
+        await _session.close()
+        _session = None
+    if _parser_pool is not None:
+        _parser_pool.shutdown(wait=False, cancel_futures=True)
+        _parser_pool = None
+
+
+def _parse_fallback(body: bytes, headers: Dict[str, str]) -> ParsedFeed:
+    # Not well-formed XML, let feedparser deal with it
+    return from_feedparser(feedparser.parse(body, response_headers=headers))
+
+
+async def _read_body(response: aiohttp.ClientResponse) -> bytes:
+    # Whole body for the parser processes, cut at MAX_FEED_BYTES
+    chunks = []
+    size = 0
+    async for data in response.content.iter_chunked(CHUNK_SIZE):
+        FETCH_BYTES.inc(len(data))
+        size += len(data)
+        if size > MAX_FEED_BYTES:
+            break
+        chunks.append(data)
+    return b''.join(chunks)
+
+
+async def _read_and_parse(loop: asyncio.AbstractEventLoop,
+                          response: aiohttp.ClientResponse,
+                          headers: Dict[str, str],
+                          known: FrozenSet[int]) -> Optional[ParsedFeed]:
+    # The body is parsed while it is downloaded, so the download stops as soon as the parser
+    # reaches entries every subscriber has already seen
+    parser = StreamingFeedParser(known)
+    streaming = True
+    truncated = False
+    chunks = []
+    size = 0
+    parse_time = 0.0
+    async for data in response.content.iter_chunked(CHUNK_SIZE):
+        FETCH_BYTES.inc(len(data))
+        size += len(data)
+        if size > MAX_FEED_BYTES:
+            truncated = True
+            break
+        # Kept for the feedparser fallback, bounded by MAX_FEED_BYTES
+        chunks.append(data)
+        if streaming:
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(_executor, parser.feed, data)
+            except ElementTree.ParseError:
+                streaming = False
+            parse_time += time.perf_counter() - start
+        if parser.done:
+            break
+
+    if not chunks:
+        return None
+    start = time.perf_counter()
+    feed = None
+    if streaming:
+        try:
+            parser.close()
+            feed = parser.result()
+        except ElementTree.ParseError:
+            # A feed cut at MAX_FEED_BYTES keeps the entries read so far
+            if truncated:
+                feed = parser.result()
+    if feed is None:
+        feed = await loop.run_in_executor(_executor, _parse_fallback, b''.join(chunks), headers)
+    PARSE_DURATION.observe(parse_time + time.perf_counter() - start)
+    return feed
+
+
+def _get_parser_pool() -> Optional[ProcessPoolExecutor]:
+    global _parser_pool
+    if _parser_pool is None and PARSER_PROCESSES > 0:
+        # A forked worker would copy the event loop, the aiohttp session and the sqlite connection.
+        # The fork server only imports the parser instead of __main__, which opens the database.
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['core.parser'])
+        _parser_pool = ProcessPoolExecutor(max_workers=PARSER_PROCESSES, mp_context=context)
+    return _parser_pool
+
+
+async def _fetch(url: str, etag: Optional[str], modified: Optional[str], known: FrozenSet[int]):
+    headers = {}
+    # Conditional request, an unchanged feed answers 304 without a body
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    loop = asyncio.get_running_loop()
+    async with _get_session().get(url, headers=headers) as response:
+        status = response.status
+        headers = {key.lower(): value for key, value in response.headers.items()}
+        if status != 200:
+            # Includes 304 Not Modified
+            return status, headers, None
+        if PARSER_PROCESSES <= 0:
+            return status, headers, await _read_and_parse(loop, response, headers, known)
+        body = await _read_body(response)
+
+    if not body:
+        return status, headers, None
+    # Only the raw bytes go to the worker process and only the ParsedFeed tuples come back,
+    # the connection is back in the pool by then
+    with PARSE_DURATION.time():
+        return status, headers, await loop.run_in_executor(_get_parser_pool(), parse_feed, body, headers, known)
+
+
+async def fetch_feed(url: str,
+                     etag: Optional[str] = None,
+                     modified: Optional[str] = None,
+                     known: FrozenSet[int] = frozenset(),
+                     timeout: float = FETCH_TIMEOUT) -> FetchResult:
+    # known holds the hashes of the entries all the subscribers have seen, see StreamingFeedParser
+    global _global_limit
+    if _global_limit is None:
+        _global_limit = asyncio.Semaphore(FETCH_CONCURRENCY)
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        host = ''
+
+    async with _global_limit, _host_limits[host]:
+        start = time.monotonic()
+        try:
+            status, headers, feed = await asyncio.wait_for(_fetch(url, etag, modified, known), timeout)
+        except Exception as error:
+            result = FetchResult(url, error=error, elapsed=time.monotonic() - start)
+        else:
+            error = RuntimeError(f'HTTP Error {status}') if status >= 400 else None
+            result = FetchResult(url, status, headers, feed, error, time.monotonic() - start)
+
+    FETCHES.inc(status=result.status or 'error')
+    FETCH_DURATION.observe(result.elapsed, host=host)
+    FEED_FETCH_SECONDS.inc(result.elapsed, url=url)
+    return result
+
+
+async def iter_body(url: str, max_bytes: int = MAX_FEED_BYTES):
+    # The body of any other document, e.g. an uploaded OPML file, chunk by chunk over the same client
+    async with _get_session().get(url) as response:
+        response.raise_for_status()
+        size = 0
+        async for data in response.content.iter_chunked(CHUNK_SIZE):
+            size += len(data)
+            if size > max_bytes:
+                raise ValueError(f'{url} is larger than {max_bytes} bytes')
+            yield data
@@ -3,37 +3,24 @@ import re
 from discord.ext import commands
 from datetime import datetime, timedelta
 
-from DatabaseManager import db_manager
+from DatabaseManager import db_manager, guild_config
 from core.constants import MESSAGES
 
 
-def update_rss_feeds():
-    return db_manager.select(
-        tables=['RssFeed'],
-        # columns=['RssFeed.server', 'RssFeed.url', 'RssHistory.timestamp'],
-        # join_conditions=['RssFeed.server = RssHistory.server AND RssFeed.url = RssHistory.url'],
-        # where_condition='RssFeed.enabled == 1',
-        # order_by=['RssHistory.timestamp DESC', 'RssFeed.server ASC']
-    )
-
-
 async def is_valid_user(ctx):
-    server_role = db_manager.get_accepted_role(ctx.guild.id)
-    server_role = int(server_role[0]['role_id']) if len(server_role) == 1 else None
+    server_role = await guild_config.get_accepted_role(ctx.guild.id)
 
     # If no server role is configured, return True
     if server_role is None:
         return True
 
     # Check if the server role exists in the guild's roles
-    guild_roles = ctx.guild.roles
-    if not any(role.id == server_role for role in guild_roles):
+    if ctx.guild.get_role(server_role) is None:
         # If the server role is not found in the guild's roles, return True
         return True
 
-    # Check if the user has the server role
-    author_roles = ctx.author.roles
-    if any(server_role == role.id for role in author_roles):
+    # Check if the user has the server role, everyone has the @everyone role
+    if server_role == ctx.guild.id or ctx.author.get_role(server_role) is not None:
         return True
     else:
         await ctx.send(MESSAGES['NoPermissions'], silent=True)
@@ -51,8 +38,10 @@ async def wait_until_next_execution():
     await asyncio.sleep((target_time - now).total_seconds())
 
 
-async def delete_old_history():
+async def delete_old_history(feed_partition=None):
     while True:
         await wait_until_next_execution()
         # print(f"This function runs at 0 seconds of every minute: {datetime.now()}")
-        db_manager.scheduled_delete_rss_history()
\ No newline at end of file
+        # A single process of a cluster cleans up the shared database
+        if feed_partition is None or feed_partition.is_leader():
+            await db_manager.scheduled_delete_rss_history()
\ No newline at end of file
@@ -0,0 +1,182 @@
+import bisect
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from core.constants import METRICS_HOST, METRICS_PORT
+
+# Seconds, from a quick 304 to a slow feed at the fetch timeout
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics: List['Metric'] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    # Minimal Prometheus metric, every distinct combination of label values is its own series
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _metrics.append(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]):
+        # Read the value when scraped, for values already tracked elsewhere
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f'{self.name} {self._function()}']
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Per series the count of every bucket (not cumulative), the +Inf bucket last, and the sum
+        self._counts: Dict[Tuple, List[int]] = {}
+        self._sums: Dict[Tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def count(self) -> int:
+        # Observations across all the series
+        return sum(sum(counts) for counts in self._counts.values())
+
+    def time(self, **labels) -> '_Timer':
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {total}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {self._sums[key]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {total}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _metrics) + '\n'
+
+
+class _RateLimitFilter(logging.Filter):
+    # discord.py handles the 429 responses itself and only logs them, count them on the way.
+    # A global limit is logged as a 429 of its request too, and then once more on its own.
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = str(record.msg)
+        if message.startswith('We are being rate limited'):
+            DISCORD_RATE_LIMITS.inc()
+        elif message.startswith('Global rate limit has been hit'):
+            DISCORD_GLOBAL_RATE_LIMITS.inc()
+        return True
+
+
+TICK_DURATION = Histogram('rss_tick_duration_seconds', 'Duration of the ticks of the fetch loop')
+FETCH_DURATION = Histogram('rss_fetch_duration_seconds', 'Duration of a feed fetch, by host', ('host',))
+FEED_FETCH_SECONDS = Counter('rss_feed_fetch_seconds_total', 'Time spent fetching every feed', ('url',))
+FETCHES = Counter('rss_fetches_total', 'Feed fetches, by outcome', ('status',))
+FETCH_BYTES = Counter('rss_fetch_bytes_total', 'Feed bytes downloaded, after decompression')
+PARSE_DURATION = Histogram('rss_parse_duration_seconds', 'Time spent parsing a feed')
+ENTRIES_POSTED = Counter('rss_entries_posted_total', 'Feed entries posted to Discord, by guild', ('server_id',))
+DB_QUERY_DURATION = Histogram('rss_db_query_duration_seconds', 'Latency of the database calls, by method', ('method',))
+DELIVERY_QUEUE_DEPTH = Gauge('rss_delivery_queue_depth', 'Deliveries waiting to be sent')
+DISCORD_RATE_LIMITS = Counter('discord_rate_limited_total', 'Discord 429 responses')
+DISCORD_GLOBAL_RATE_LIMITS = Counter('discord_global_rate_limited_total', 'Discord 429 responses hitting the global limit')
+
+logging.getLogger('discord.http').addFilter(_RateLimitFilter())
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    # Serves /metrics in the Prometheus text format, disabled when port is 0
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f'Metrics served on http://{host}:{port}/metrics')
+    return runner
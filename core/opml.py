@@ -0,0 +1,183 @@
+import asyncio
+import re
+import traceback
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import Dict, Iterable, List, NamedTuple, Optional
+from xml.etree import ElementTree
+
+import discord
+
+from DatabaseManager import db_manager, guild_config
+from core.delivery import TokenBucket
+from core.fetcher import fetch_feed, is_valid_url, iter_body
+
+# Upper bounds of a single import
+MAX_OPML_BYTES = 4 * 1024 * 1024
+MAX_OPML_FEEDS = 1000
+OPML_TIMEOUT = 60
+# Channels created per second, and at once, by an import. discord.py waits out the 429s
+# on its own, the bucket keeps a large import from running into them in the first place.
+CHANNEL_CREATE_RATE = 1.0
+CHANNEL_CREATE_BURST = 5
+
+
+class OpmlFeed(NamedTuple):
+    name: str
+    url: str
+    channel_name: str
+
+
+class ImportResult(NamedTuple):
+    added: List[OpmlFeed]
+    existing: List[OpmlFeed]
+    invalid: List[OpmlFeed]
+
+
+def channel_slug(name: str) -> str:
+    # The name Discord gives a text channel created with this name
+    slug = re.sub(r'[\s\-]+', '-', name.strip().lower()).strip('-')
+    return slug[:100] or 'rss-feeds'
+
+
+class OpmlParser:
+    # Reads the feed outlines of an OPML document while it is downloaded. A feed is posted in a
+    # channel named after the outline it is nested in, or after the feed itself at the top level.
+    # Closed elements are cleared, so memory is bounded by the feeds found and not the document.
+    def __init__(self, max_feeds: int = MAX_OPML_FEEDS):
+        self.max_feeds = max_feeds
+        self.feeds: 'OrderedDict[str, OpmlFeed]' = OrderedDict()
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        # The text of the enclosing outlines, None for feed outlines
+        self._outlines: List[Optional[str]] = []
+
+    @property
+    def full(self) -> bool:
+        return len(self.feeds) >= self.max_feeds
+
+    def feed(self, data: bytes):
+        self._parser.feed(data)
+        self._read_events()
+
+    def close(self):
+        self._parser.close()
+        self._read_events()
+
+    def _read_events(self):
+        for event, element in self._parser.read_events():
+            if element.tag != 'outline':
+                continue
+            if event == 'end':
+                self._outlines.pop()
+                element.clear()
+                continue
+
+            name = (element.get('text') or element.get('title') or '').strip()
+            url = (element.get('xmlUrl') or '').strip()
+            if not url:
+                self._outlines.append(name)
+                continue
+            self._outlines.append(None)
+
+            categories = [outline for outline in self._outlines[:-1] if outline]
+            channel_name = channel_slug(categories[-1] if categories else name or url)
+            # The first outline of a URL wins, like the unique (server_id, url) of RssFeed
+            if url not in self.feeds and not self.full:
+                self.feeds[url] = OpmlFeed(name or url, url, channel_name)
+
+
+async def read_opml(url: str, max_bytes: int = MAX_OPML_BYTES, max_feeds: int = MAX_OPML_FEEDS) -> List[OpmlFeed]:
+    parser = OpmlParser(max_feeds)
+    async with aclosing(iter_body(url, max_bytes)) as body:
+        async for data in body:
+            parser.feed(data)
+            # The rest of the document isn't downloaded
+            if parser.full:
+                break
+        else:
+            parser.close()
+    return list(parser.feeds.values())
+
+
+def write_opml(title: str, feeds: Iterable) -> bytes:
+    # One outline per channel, holding the outlines of its feeds, which read_opml imports back as is
+    root = ElementTree.Element('opml', version='2.0')
+    ElementTree.SubElement(ElementTree.SubElement(root, 'head'), 'title').text = title
+    body = ElementTree.SubElement(root, 'body')
+    channels: Dict[str, ElementTree.Element] = {}
+    for feed in feeds:
+        channel = channels.get(feed['channel_name'])
+        if channel is None:
+            channel = channels[feed['channel_name']] = ElementTree.SubElement(
+                body, 'outline', text=feed['channel_name'], title=feed['channel_name'])
+        ElementTree.SubElement(channel, 'outline', type='rss', text=feed['name'], title=feed['name'],
+                               xmlUrl=feed['url'])
+    ElementTree.indent(root)
+    return ElementTree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+
+async def validate_feeds(feeds: List[OpmlFeed]) -> List[bool]:
+    # Every feed is fetched once, concurrently within the limits of the fetcher
+    results = await asyncio.gather(*(fetch_feed(feed.url) for feed in feeds))
+    return [result.error is None and result.feed is not None for result in results]
+
+
+async def create_channels(guild: discord.Guild, channel_router, names: Iterable[str]) -> Dict[str, discord.TextChannel]:
+    # The channels named, found by name or created in the RSS FEEDS category under a rate limit
+    channels = {}
+    missing = []
+    for name in set(names):
+        channel = channel_router.get_channel_by_name(guild, name)
+        if channel is None:
+            missing.append(name)
+        else:
+            channels[name] = channel
+    if not missing:
+        return channels
+
+    category = await channel_router.get_category(guild)
+    bucket = TokenBucket(CHANNEL_CREATE_RATE, CHANNEL_CREATE_BURST)
+
+    async def create(name):
+        await bucket.acquire()
+        try:
+            channel = await guild.create_text_channel(name=name, category=category)
+        except Exception:
+            print(f'Error creating channel \'{name}\' in server \'{guild.name}\':')
+            print(traceback.format_exc())
+            return
+        channel_router.add_channel(channel)
+        channels[name] = channel
+
+    await asyncio.gather(*map(create, missing))
+    return channels
+
+
+async def import_opml(guild: discord.Guild, channel_router, url: str, enabled: bool = True,
+                      digest: bool = False) -> ImportResult:
+    feeds = await asyncio.wait_for(read_opml(url), OPML_TIMEOUT)
+    existing_urls = {feed['url'] for feed in await db_manager.get_rss_feeds(guild.id)}
+    existing = [feed for feed in feeds if feed.url in existing_urls]
+    feeds = [feed for feed in feeds if feed.url not in existing_urls]
+
+    invalid = [feed for feed in feeds if not is_valid_url(feed.url)]
+    feeds = [feed for feed in feeds if is_valid_url(feed.url)]
+    valid = await validate_feeds(feeds)
+    invalid += [feed for feed, ok in zip(feeds, valid) if not ok]
+    feeds = [feed for feed, ok in zip(feeds, valid) if ok]
+
+    channels = await create_channels(guild, channel_router, (feed.channel_name for feed in feeds))
+    invalid += [feed for feed in feeds if feed.channel_name not in channels]
+    feeds = [feed for feed in feeds if feed.channel_name in channels]
+
+    # All the subscriptions are added in one transaction
+    await guild_config.add_rss_feeds(guild.id, [{
+        'server_id': guild.id,
+        'name': feed.name,
+        'url': feed.url,
+        'channel_name': channels[feed.channel_name].name,
+        'channel_id': channels[feed.channel_name].id,
+        'enabled': enabled,
+        'digest': digest,
+    } for feed in feeds])
+    return ImportResult(feeds, existing, invalid)
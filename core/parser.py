@@ -0,0 +1,181 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import FrozenSet, List, NamedTuple, Optional
+from xml.etree import ElementTree
+
+import dateutil.parser as dt_parser
+import feedparser
+
+from core.constants import MAX_FEED_ENTRIES
+from core.dedup import entry_hash
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+RSS1 = '{http://purl.org/rss/1.0/}'
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+
+ENTRY_TAGS = {'item', f'{RSS1}item', f'{ATOM}entry'}
+FEED_TAGS = {'channel', f'{RSS1}channel', f'{ATOM}feed'}
+# Stop reading once this many entries in a row were already seen by every subscriber
+STOP_AFTER_KNOWN = 5
+
+
+class ParsedEntry(NamedTuple):
+    id: Optional[str]
+    title: Optional[str]
+    link: Optional[str]
+    # Naive UTC datetime, like the rest of the history timestamps
+    published: Optional[datetime]
+
+
+class ParsedFeed(NamedTuple):
+    title: Optional[str]
+    ttl: Optional[str]
+    entries: List[ParsedEntry]
+
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            date = dt_parser.isoparse(value)
+        except ValueError:
+            return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def _text(element: ElementTree.Element, *tags: str) -> Optional[str]:
+    for tag in tags:
+        child = element.find(tag)
+        if child is not None and child.text and child.text.strip():
+            return child.text.strip()
+    return None
+
+
+def _link(element: ElementTree.Element) -> Optional[str]:
+    for link in element.findall(f'{ATOM}link'):
+        if link.get('rel', 'alternate') == 'alternate' and link.get('href'):
+            return link.get('href')
+    return _text(element, 'link', f'{RSS1}link')
+
+
+def _entry(element: ElementTree.Element) -> ParsedEntry:
+    return ParsedEntry(
+        id=_text(element, 'guid', f'{ATOM}id') or element.get(f'{RDF}about'),
+        title=_text(element, 'title', f'{ATOM}title', f'{RSS1}title'),
+        link=_link(element),
+        published=_parse_date(_text(element, 'pubDate', f'{ATOM}published', f'{ATOM}issued',
+                                    f'{ATOM}updated', f'{DC}date')))
+
+
+def from_feedparser(feed) -> ParsedFeed:
+    entries = []
+    for entry in feed.entries:
+        published = entry.get('published_parsed') or entry.get('updated_parsed')
+        entries.append(ParsedEntry(
+            id=entry.get('id'),
+            title=entry.get('title'),
+            link=entry.get('link'),
+            published=datetime(*published[:6]) if published else None))
+    return ParsedFeed(feed.feed.get('title'), feed.feed.get('ttl'), entries)
+
+
+class StreamingFeedParser:
+    # Incremental RSS 2.0 / RSS 1.0 / Atom parser. Every entry is turned into a ParsedEntry and
+    # dropped from the tree as soon as it is closed, so memory is bounded by the entries kept.
+    # Once the dates show the feed lists its newest entries first, parsing is done after
+    # max_entries entries or STOP_AFTER_KNOWN entries in a row with a hash in known. Any other
+    # feed is read to the end and only its newest max_entries entries are kept.
+    def __init__(self, known: FrozenSet[int] = frozenset(), max_entries: int = MAX_FEED_ENTRIES):
+        self.known = known
+        self.max_entries = max_entries
+        self.title = None
+        self.ttl = None
+        self.entries: List[ParsedEntry] = []
+        self.done = False
+        self._known_run = 0
+        # Date of the last dated entry, and whether the dates fell and rose between entries so far
+        self._last_published: Optional[datetime] = None
+        self._fell = False
+        self._rose = False
+        self._stack: List[ElementTree.Element] = []
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+
+    def feed(self, data: bytes):
+        if self.done:
+            return
+        self._parser.feed(data)
+        self._read_events()
+
+    def close(self):
+        if not self.done:
+            self._parser.close()
+            self._read_events()
+            self.done = True
+
+    @property
+    def newest_first(self) -> bool:
+        return self._fell and not self._rose
+
+    def _trim(self):
+        # Keep the newest max_entries entries in document order, undated entries count as the oldest
+        # and the first ones win among entries of the same date
+        if len(self.entries) <= self.max_entries:
+            return
+        order = sorted(range(len(self.entries)), reverse=True,
+                       key=lambda i: (self.entries[i].published or datetime.min, -i))
+        keep = sorted(order[:self.max_entries])
+        self.entries = [self.entries[i] for i in keep]
+
+    def result(self) -> ParsedFeed:
+        self._trim()
+        return ParsedFeed(self.title, self.ttl, self.entries)
+
+    def _read_events(self):
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                self._stack.append(element)
+                continue
+
+            self._stack.pop()
+            parent = self._stack[-1] if self._stack else None
+            if element.tag in ENTRY_TAGS:
+                entry = _entry(element)
+                self.entries.append(entry)
+                if parent is not None:
+                    parent.remove(element)
+
+                if entry.published is not None:
+                    if self._last_published is not None:
+                        self._fell |= entry.published < self._last_published
+                        self._rose |= entry.published > self._last_published
+                    self._last_published = entry.published
+
+                self._known_run = self._known_run + 1 if entry_hash(entry) in self.known else 0
+                if self.newest_first:
+                    if self._known_run >= STOP_AFTER_KNOWN or len(self.entries) >= self.max_entries:
+                        self.done = True
+                        return
+                elif len(self.entries) >= 2 * self.max_entries:
+                    self._trim()
+            elif parent is not None and parent.tag in FEED_TAGS:
+                if element.tag in ('title', f'{ATOM}title', f'{RSS1}title') and self.title is None:
+                    self.title = (element.text or '').strip()
+                elif element.tag == 'ttl':
+                    self.ttl = (element.text or '').strip()
+
+
+def parse_feed(body: bytes, headers: dict = None, known: FrozenSet[int] = frozenset()) -> ParsedFeed:
+    # Parse a complete document, falling back to feedparser for anything that isn't well-formed XML
+    parser = StreamingFeedParser(known)
+    try:
+        parser.feed(body)
+        parser.close()
+        return parser.result()
+    except ElementTree.ParseError:
+        return from_feedparser(feedparser.parse(body, response_headers=headers or {}))
@@ -0,0 +1,236 @@
+import asyncio
+import traceback
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import dateutil.parser as dt_parser
+from dateutil.relativedelta import relativedelta
+
+from core.dedup import entry_hash
+from core.delivery import DIGEST_SIZE, Delivery, DeliveryEntry
+from core.fetcher import FetchResult, fetch_feed, normalize_url
+from core.metrics import TICK_DURATION
+from core.scheduler import CADENCE_SAMPLES, FeedScheduler
+
+
+class FeedPipeline:
+    # Polls the due feeds and hands their new entries to deliveries, anything with a put(Delivery).
+    # Runs inside the bot, or in the standalone fetcher process with a durable queue as deliveries.
+    def __init__(self, db_manager, history_buffer, seen_entries, deliveries, feed_partition, subscriptions):
+        self.db_manager = db_manager
+        self.history_buffer = history_buffer
+        self.seen_entries = seen_entries
+        self.deliveries = deliveries
+        self.feed_partition = feed_partition
+        # Decides which feeds are due on every tick
+        self.feed_scheduler = FeedScheduler()
+        # The enabled subscriptions owned by this process, grouped by feed so every distinct URL is
+        # fetched once. Kept up to date from the changes of the registry, a tick costs the same
+        # however many subscriptions there are.
+        self.subscriptions = subscriptions
+        self._feeds = defaultdict(dict)
+        self._added = set()
+        subscriptions.add_listener(self._subscription_changed)
+
+    def _subscription_changed(self, key, old, new):
+        if old is not None:
+            self._remove_subscription(key, normalize_url(old['url']))
+        if new is None:
+            # The hashes are read again if the feed is added back
+            self.seen_entries.forget(*key)
+        else:
+            url = normalize_url(new['url'])
+            if new['enabled'] and self.feed_partition.owns(url):
+                self._feeds[url][key] = new
+                self._update_feed(url)
+
+    def _remove_subscription(self, key, url):
+        feed = self._feeds.get(url)
+        if feed is not None and feed.pop(key, None) is not None:
+            if not feed:
+                del self._feeds[url]
+            self._update_feed(url)
+
+    def _update_feed(self, url):
+        if self.feed_scheduler.update(url, set(self._feeds.get(url, ()))):
+            self._added.add(url)
+
+    def _regroup(self):
+        # The feeds owned by this process changed, group all the subscriptions again
+        for url in list(self._feeds):
+            del self._feeds[url]
+            self._update_feed(url)
+        self._added.clear()
+        for rss_channel in self.subscriptions.values():
+            self._subscription_changed((rss_channel['server_id'], rss_channel['url']), None, rss_channel)
+
+    async def tick(self):
+        # Fetches the feeds that are due
+        with TICK_DURATION.time():
+            await self._tick()
+
+    async def _tick(self):
+        # Write the history of everything sent since the last tick in one transaction
+        try:
+            await self.history_buffer.flush()
+        except Exception:
+            print(f"Error saving the RSS history:")
+            print(traceback.format_exc())
+
+        # Only the subscriptions changed since the last tick are read
+        await self.subscriptions.sync()
+
+        try:
+            if await self.feed_partition.heartbeat():
+                # Feeds taken over from another process are read again from the database
+                self.seen_entries.clear()
+                await self.history_buffer.load()
+                self._regroup()
+        except Exception:
+            print(f"Error updating the feed workers:")
+            print(traceback.format_exc())
+
+        # Learn the publish cadence of newly seen feeds from their history
+        added, self._added = self._added, set()
+        for url in added:
+            if url not in self._feeds:
+                continue
+            history = await self.db_manager.get_rss_history_timestamps(
+                [rss_channel['url'] for rss_channel in self._feeds[url].values()], limit=CADENCE_SAMPLES)
+            self.feed_scheduler.learn(url, [dt_parser.parse(row['timestamp']).replace(tzinfo=timezone.utc).timestamp()
+                                            for row in history])
+
+        urls = self.feed_scheduler.pop_due()
+        if not urls:
+            return
+
+        print("Sending RSS Feeds...")
+        try:
+            await self.fetch_due(urls)
+        finally:
+            # A feed left without a next poll would never be polled again, whatever failed
+            for url in urls:
+                if self.feed_scheduler.in_flight(url):
+                    self.feed_scheduler.record_error(url)
+
+    async def fetch_due(self, urls):
+        # The subscriptions of the due feeds as they are now, the registry may change while they are fetched
+        subscriptions = {url: list(self._feeds.get(url, {}).values()) for url in urls}
+
+        # Send the stored validators so unchanged feeds answer 304 without being parsed,
+        # unless a subscription has nothing seen yet and needs the full feed
+        feed_cache = {cache['url']: cache for cache in await self.db_manager.get_feed_caches(urls)}
+
+        async def conditional_fetch(url):
+            # Entries seen by every subscriber let the parser stop reading the feed early
+            try:
+                seen = [await self.seen_entries.get(rss_channel['server_id'], rss_channel['url'])
+                        for rss_channel in subscriptions[url]]
+            except Exception as error:
+                # Fails this feed only, not the whole batch
+                return FetchResult(url, error=error)
+            known = frozenset(seen[0]).intersection(*seen[1:]) if seen else frozenset()
+
+            cache = feed_cache.get(url)
+            if cache is None or not all(seen):
+                return await fetch_feed(url, known=known)
+            return await fetch_feed(url, etag=cache['etag'], modified=cache['modified'], known=known)
+
+        # Fetch and parse all the due RSS feeds concurrently
+        results = await asyncio.gather(*map(conditional_fetch, urls))
+
+        await self.queue_fetch_results(urls, results, subscriptions, feed_cache)
+
+    async def queue_fetch_results(self, urls, results, subscriptions, feed_cache):
+        for url, result in zip(urls, results):
+            try:
+                await self.queue_fetch_result(url, result, subscriptions, feed_cache)
+            except Exception:
+                print(f"Error handling the RSS feed '{url}':")
+                print(traceback.format_exc())
+            finally:
+                if self.feed_scheduler.in_flight(url):
+                    self.feed_scheduler.record_error(url, result.headers)
+
+    async def queue_fetch_result(self, url, result, subscriptions, feed_cache):
+        if result.error is not None:
+            print(f"Failed to fetch RSS feed '{url}': {result.error!r}")
+            self.feed_scheduler.record_error(url, result.headers)
+            return
+        if result.status == 304:
+            self.feed_scheduler.record_success(url, result.headers)
+            return
+
+        etag = result.headers.get('etag')
+        modified = result.headers.get('last-modified')
+        cache = feed_cache.get(url)
+        if (etag or modified) and (cache is None or (cache['etag'], cache['modified']) != (etag, modified)):
+            await self.db_manager.set_feed_cache(url, etag, modified)
+
+        feed = result.feed
+        entries = list(reversed(feed.entries)) if feed else []
+        self.feed_scheduler.record_success(
+            url, result.headers,
+            ttl=feed.ttl if feed else None,
+            published=[entry.published.replace(tzinfo=timezone.utc).timestamp() for entry in entries if entry.published])
+
+        for rss_channel in subscriptions[url]:
+            try:
+                await self.queue_rss_entries(rss_channel, feed, entries)
+            except Exception:
+                print(f"Error queueing the RSS feed '{rss_channel['url']}':")
+                print(traceback.format_exc())
+
+    async def queue_rss_entries(self, rss_channel, feed, entries):
+        feed_name = rss_channel['name']
+        server_id = rss_channel['server_id']
+        feed_url = rss_channel['url']
+        channel_name = rss_channel['channel_name']
+        channel_id = rss_channel['channel_id']
+
+        # An entry is new when its hash was never seen. Feeds sent before the hash index existed
+        # only have the timestamp of their latest entry, so on their first run the older entries
+        # are marked as seen instead of being sent again.
+        seen = await self.seen_entries.get(server_id, feed_url)
+        last_seen = self.history_buffer.last_seen(server_id, feed_url)
+        legacy = not seen and last_seen is not None
+        cutoff = datetime.now() - relativedelta(months=1)
+
+        # Check for new entries and queue them for the Discord channel
+        new_entries = []
+        for entry in entries:
+            hash_ = entry_hash(entry)
+            if hash_ in seen:
+                continue
+
+            published = entry.published
+            if published is not None and published <= cutoff:
+                # Stored with the time it was seen, a hash stored with its date would be deleted by
+                # the next cleanup while the feed still lists the entry
+                seen.add(hash_)
+                self.history_buffer.mark_seen(server_id, feed_url, hash_)
+                continue
+            if legacy and (published is None or published <= last_seen):
+                seen.add(hash_)
+                self.history_buffer.mark_seen(server_id, feed_url, hash_, published)
+                continue
+
+            # Marked as seen right away so the next poll doesn't queue it again while it waits
+            seen.add(hash_)
+            new_entries.append(DeliveryEntry(
+                title=entry.title or entry.link or '',
+                link=entry.link or '',
+                timestamp=published,
+                entry_hash=hash_))
+
+        # Digest feeds send their new entries in as few messages as possible
+        size = DIGEST_SIZE if rss_channel['digest'] else 1
+        for i in range(0, len(new_entries), size):
+            self.deliveries.put(Delivery(
+                server_id=server_id,
+                url=feed_url,
+                channel_id=channel_id,
+                channel_name=channel_name,
+                feed_title=feed.title or feed_name,
+                entries=tuple(new_entries[i:i + size]),
+                digest=bool(rss_channel['digest'])))
@@ -0,0 +1,149 @@
+import time
+import traceback
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import discord
+
+from DatabaseManager import guild_config
+
+CATEGORY_NAME = 'RSS FEEDS'
+# Channels fetched over REST, kept for CHANNEL_CACHE_TTL seconds, at most CHANNEL_CACHE_SIZE of them
+CHANNEL_CACHE_SIZE = 1024
+CHANNEL_CACHE_TTL = 300
+
+
+class ChannelCache:
+    # Looks channels up by id in the gateway cache and only fetches them over REST when the
+    # gateway doesn't have them, e.g. a guild on another shard. The fetched channels, and the
+    # channels that don't exist, are kept for a while so repeated lookups cost no request.
+    def __init__(self, size: int = CHANNEL_CACHE_SIZE, ttl: float = CHANNEL_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._fetched: 'OrderedDict[int, Tuple[float, Optional[discord.abc.GuildChannel]]]' = OrderedDict()
+
+    def invalidate(self, channel_id: int):
+        self._fetched.pop(channel_id, None)
+
+    async def get(self, client: discord.Client, channel_id: int) -> Optional[discord.abc.GuildChannel]:
+        channel = client.get_channel(channel_id)
+        if channel is not None:
+            return channel
+
+        now = time.monotonic()
+        cached = self._fetched.get(channel_id)
+        if cached is not None and cached[0] > now:
+            self._fetched.move_to_end(channel_id)
+            return cached[1]
+
+        try:
+            channel = await client.fetch_channel(channel_id)
+        except (discord.NotFound, discord.Forbidden):
+            channel = None
+
+        self._fetched[channel_id] = (now + self.ttl, channel)
+        self._fetched.move_to_end(channel_id)
+        while len(self._fetched) > self.size:
+            self._fetched.popitem(last=False)
+        return channel
+
+
+class ChannelRouter:
+    # Resolves the channel of a feed in O(1). Guilds and channels by id come from the
+    # gateway cache of the bot, which is already keyed by id. The channels by name and the
+    # RSS FEEDS category, which discord.py only offers as linear scans, are indexed here and
+    # kept up to date from the guild and channel events.
+    def __init__(self, bot: discord.Client):
+        self.bot = bot
+        self._categories: Dict[int, discord.CategoryChannel] = {}
+        self._channel_names: Dict[int, Dict[str, discord.TextChannel]] = {}
+
+    def index_guild(self, guild: discord.Guild):
+        self._channel_names[guild.id] = {}
+        self._categories.pop(guild.id, None)
+        for channel in guild.channels:
+            self.add_channel(channel)
+
+    def remove_guild(self, guild: discord.Guild):
+        self._channel_names.pop(guild.id, None)
+        self._categories.pop(guild.id, None)
+
+    def add_channel(self, channel: discord.abc.GuildChannel):
+        if isinstance(channel, discord.TextChannel):
+            # Keep the first channel with a given name, like discord.utils.get would
+            names = self._channel_names.setdefault(channel.guild.id, {})
+            if channel.name not in names or names[channel.name].position > channel.position:
+                names[channel.name] = channel
+        elif isinstance(channel, discord.CategoryChannel) and channel.name == CATEGORY_NAME:
+            self._categories.setdefault(channel.guild.id, channel)
+
+    def remove_channel(self, channel: discord.abc.GuildChannel):
+        if isinstance(channel, discord.TextChannel):
+            names = self._channel_names.get(channel.guild.id, {})
+            if names.get(channel.name) is not None and names[channel.name].id == channel.id:
+                del names[channel.name]
+                # Another channel may share the name
+                replacement = discord.utils.get(channel.guild.text_channels, name=channel.name)
+                if replacement is not None and replacement.id != channel.id:
+                    names[channel.name] = replacement
+        elif isinstance(channel, discord.CategoryChannel):
+            category = self._categories.get(channel.guild.id)
+            if category is not None and category.id == channel.id:
+                del self._categories[channel.guild.id]
+                replacement = discord.utils.get(channel.guild.categories, name=CATEGORY_NAME)
+                if replacement is not None and replacement.id != channel.id:
+                    self._categories[channel.guild.id] = replacement
+
+    def update_channel(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        self.remove_channel(before)
+        self.add_channel(after)
+
+    def is_local(self, server_id: int) -> bool:
+        # Whether the guild is on a gateway shard of this process
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        return not self.bot.shard_count or shard_ids is None or (server_id >> 22) % self.bot.shard_count in shard_ids
+
+    def get_channel_by_name(self, guild: discord.Guild, name: str) -> Optional[discord.TextChannel]:
+        return self._channel_names.get(guild.id, {}).get(name)
+
+    async def get_category(self, guild: discord.Guild) -> Optional[discord.CategoryChannel]:
+        category = self._categories.get(guild.id)
+        if category is None:
+            try:
+                category = await guild.create_category(name=CATEGORY_NAME)
+                self._categories[guild.id] = category
+                print(f"Created category: {CATEGORY_NAME}")
+            except Exception as e:
+                print(f'Error creating category \'{CATEGORY_NAME}\' in server \'{guild.name}\':')
+                print(traceback.format_exc())
+        return category
+
+    async def resolve(self, server_id: int, url: str, channel_id: int, channel_name: str) \
+            -> Optional[discord.abc.Messageable]:
+        guild = self.bot.get_guild(server_id)
+        if guild is None:
+            # Guilds on the shards of another process are only reachable over REST
+            if not self.is_local(server_id):
+                return self.bot.get_partial_messageable(channel_id, guild_id=server_id)
+            return None
+
+        channel = guild.get_channel(channel_id)
+        if isinstance(channel, discord.TextChannel):
+            return channel
+
+        # The configured channel is gone, use a channel with the same name or create it again
+        try:
+            channel = self.get_channel_by_name(guild, channel_name)
+            if channel is None:
+                category = await self.get_category(guild)
+                channel = await guild.create_text_channel(name=channel_name, category=category)
+                self.add_channel(channel)
+                print(f"Created channel: {channel_name} in category {CATEGORY_NAME}")
+            await guild_config.update_rss_feed(server_id, url, {'channel_id': channel.id})
+        except Exception as e:
+            print(f'Error creating channel \'{channel_name}\' in server \'{guild.name}\':')
+            print(traceback.format_exc())
+        return channel
+
+
+channel_cache = ChannelCache()
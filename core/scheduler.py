@@ -0,0 +1,136 @@
+import heapq
+import random
+import time
+from email.utils import parsedate_to_datetime
+from statistics import median
+from typing import Dict, Iterable, List, Optional, Set
+
+from core.constants import POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+
+# Number of recent entries used to learn the publish cadence of a feed
+CADENCE_SAMPLES = 20
+
+
+def _parse_retry_after(value: Optional[str], now: float) -> Optional[float]:
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return parsedate_to_datetime(value).timestamp() - now
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_max_age(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    for directive in value.split(','):
+        name, _, seconds = directive.strip().partition('=')
+        if name.lower() in ('max-age', 's-maxage') and seconds.strip().isdigit():
+            return float(seconds)
+    return None
+
+
+class FeedScheduler:
+    # Priority queue of feed URLs keyed on their next due time (epoch seconds).
+    # Stale heap items are skipped lazily by comparing against self._due.
+    def __init__(self, min_interval: float = POLL_MIN_INTERVAL, max_interval: float = POLL_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._queue = []
+        self._due: Dict[str, float] = {}
+        self._intervals: Dict[str, float] = {}
+        self._errors: Dict[str, int] = {}
+        self._subscribers: Dict[str, Set] = {}
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._due
+
+    def _schedule(self, url: str, due: float):
+        self._due[url] = due
+        heapq.heappush(self._queue, (due, url))
+
+    def update(self, url: str, keys: Set, now: float = None) -> bool:
+        # Track the subscriptions of a single URL, none stops polling it. True when the URL is new.
+        if not keys:
+            self._due.pop(url, None)
+            self._intervals.pop(url, None)
+            self._errors.pop(url, None)
+            self._subscribers.pop(url, None)
+            return False
+
+        now = time.time() if now is None else now
+        added = url not in self._due
+        if added:
+            # Spread new feeds over the first interval instead of polling them all at once
+            self._intervals[url] = self.min_interval
+            self._schedule(url, now + random.uniform(0, self.min_interval))
+        elif not keys <= self._subscribers[url]:
+            # A new subscription wants its initial entries as soon as possible
+            self._schedule(url, now)
+        self._subscribers[url] = set(keys)
+        return added
+
+    def pop_due(self, now: float = None) -> List[str]:
+        now = time.time() if now is None else now
+        urls = []
+        while self._queue and self._queue[0][0] <= now:
+            due, url = heapq.heappop(self._queue)
+            if self._due.get(url) == due:
+                # Keep a placeholder until the fetch reports back
+                self._due[url] = float('inf')
+                urls.append(url)
+        return urls
+
+    def in_flight(self, url: str) -> bool:
+        # Popped by pop_due and not rescheduled by record_success or record_error yet
+        return self._due.get(url) == float('inf')
+
+    def learn(self, url: str, published: Iterable[float], now: float = None):
+        # Poll about twice per expected publish gap, the time since the latest entry counts as a gap
+        # so feeds that went quiet drift towards the maximum interval
+        now = time.time() if now is None else now
+        published = sorted(set(published))[-CADENCE_SAMPLES:]
+        if not published:
+            return
+        gaps = [later - earlier for earlier, later in zip(published, published[1:])]
+        gaps.append(max(now - published[-1], 0))
+        interval = median(gaps) / 2
+        self._intervals[url] = min(max(interval, self.min_interval), self.max_interval)
+
+    def record_success(self,
+                       url: str,
+                       headers: Dict[str, str] = None,
+                       ttl: Optional[str] = None,
+                       published: Iterable[float] = None,
+                       now: float = None):
+        if url not in self._due:
+            return
+        now = time.time() if now is None else now
+        if published:
+            self.learn(url, published, now)
+        self._errors.pop(url, None)
+
+        # Never poll faster than the publisher asked for
+        interval = self._intervals.get(url, self.min_interval)
+        if ttl and str(ttl).strip().isdigit():
+            interval = max(interval, int(ttl) * 60)
+        max_age = _parse_max_age((headers or {}).get('cache-control'))
+        if max_age:
+            interval = max(interval, max_age)
+        self._schedule(url, now + min(interval, self.max_interval))
+
+    def record_error(self, url: str, headers: Dict[str, str] = None, now: float = None):
+        if url not in self._due:
+            return
+        now = time.time() if now is None else now
+        errors = self._errors.get(url, 0) + 1
+        self._errors[url] = errors
+
+        # Exponential backoff, unless the server told us when to come back
+        interval = min(self._intervals.get(url, self.min_interval) * 2 ** min(errors, 10), self.max_interval)
+        retry_after = _parse_retry_after((headers or {}).get('retry-after'), now)
+        if retry_after is not None:
+            interval = max(interval, retry_after)
+        self._schedule(url, now + interval)
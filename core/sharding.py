@@ -0,0 +1,87 @@
+import bisect
+import hashlib
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from core.constants import CLUSTER_HEARTBEAT_TIMEOUT, CLUSTER_INDEX, CLUSTER_SIZE, SHARD_COUNT
+
+# Points of every process on the hash ring, more points spread the feeds more evenly
+RING_REPLICAS = 64
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def is_sharded() -> bool:
+    return SHARD_COUNT > 0 or CLUSTER_SIZE > 1
+
+
+def get_shard_count() -> Optional[int]:
+    # None lets Discord decide, only possible when a single process runs all the shards.
+    # discord.py needs the count with explicit shard ids, a cluster runs a shard per process by default.
+    if CLUSTER_SIZE <= 1:
+        return SHARD_COUNT or None
+    return SHARD_COUNT or CLUSTER_SIZE
+
+
+def get_shard_ids() -> Optional[List[int]]:
+    # The gateway shards run by this process, None lets discord.py run all of them
+    if CLUSTER_SIZE <= 1:
+        return None
+    return [shard_id for shard_id in range(get_shard_count()) if shard_id % CLUSTER_SIZE == CLUSTER_INDEX]
+
+
+class HashRing:
+    # Consistent hash ring, a key belongs to the first node clockwise from its hash, so adding
+    # or removing a node only moves the keys of that node
+    def __init__(self, nodes: Iterable[int], replicas: int = RING_REPLICAS):
+        self.nodes = frozenset(nodes)
+        ring = sorted((_hash(f'{node}:{replica}'), node) for node in self.nodes for replica in range(replicas))
+        self._keys = [key for key, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def owner(self, key: str) -> Optional[int]:
+        if not self._keys:
+            return None
+        return self._nodes[bisect.bisect(self._keys, _hash(key)) % len(self._keys)]
+
+
+class FeedPartition:
+    # Slice of the distinct feed URLs fetched by this process. Every process of a cluster
+    # heartbeats in the FeedWorker table of the shared database and the URLs are spread over
+    # the live ones, so the feeds of a process that stops are picked up by the others.
+    def __init__(self,
+                 db_manager,
+                 index: int = CLUSTER_INDEX,
+                 size: int = CLUSTER_SIZE,
+                 timeout: float = CLUSTER_HEARTBEAT_TIMEOUT):
+        self.db_manager = db_manager
+        self.index = index
+        self.size = size
+        self.timeout = timeout
+        # A process of a cluster owns no feed until its first heartbeat read the live ones,
+        # otherwise it would fetch every feed of the processes it doesn't know of yet
+        self.ring = HashRing([index] if size <= 1 else [])
+
+    async def heartbeat(self) -> bool:
+        # Returns True when the live processes changed, and with them the owned feeds
+        if self.size <= 1:
+            return False
+        now = datetime.now()
+        await self.db_manager.set_feed_worker_heartbeat(self.index, now.isoformat())
+        rows = await self.db_manager.get_feed_workers((now - timedelta(seconds=self.timeout)).isoformat())
+        workers = {row['worker_index'] for row in rows} | {self.index}
+        if workers == self.ring.nodes:
+            return False
+
+        print(f"Feed workers changed to {sorted(workers)}")
+        self.ring = HashRing(workers)
+        return True
+
+    def owns(self, url: str) -> bool:
+        return self.ring.owner(url) == self.index
+
+    def is_leader(self) -> bool:
+        # The live process with the lowest index runs the cluster wide maintenance
+        return bool(self.ring.nodes) and self.index == min(self.ring.nodes)
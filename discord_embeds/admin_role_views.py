@@ -1,18 +1,16 @@
 import discord
 from discord.ui import Select, View
 
-from DatabaseManager import db_manager
+from DatabaseManager import guild_config
 
 class UpdateAdminRole(View):
-    def __init__(self, ctx):
+    def __init__(self, ctx, server_role):
         super().__init__()
         self.ctx = ctx
         self.server = ctx.guild
         # ToDo: Handle more that 25 roles
         self.roles = ctx.author.roles[:25]
 
-        server_role = db_manager.get_accepted_role(ctx.guild.id)
-        server_role = int(server_role[0]['role_id']) if len(server_role) == 1 else None
         self.server_role = server_role
 
         # Create a Select menu with options populated from the server's text channels
@@ -40,11 +38,7 @@ class UpdateAdminRole(View):
             return
 
         # Do something with the selected channel (e.g., save it as the configured channel)
-        data = {
-            'server_id': self.server.id,
-            'role_id': selected_role
-        }
-        db_manager.update('AcceptedRole', data, f'(server_id = {self.server.id})')
+        await guild_config.update_accepted_role(self.server.id, selected_role)
 
         await interaction.response.send_message(f"Role `{role.name}` has been selected.", silent=True)
         await self.terminate_ui(interaction)
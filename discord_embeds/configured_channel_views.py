@@ -1,7 +1,7 @@
 import discord
 from discord.ui import Select, View, Button
 
-from DatabaseManager import db_manager
+from DatabaseManager import guild_config
 
 
 class UpdateConfiguredChannel(View):
@@ -70,12 +70,8 @@ class UpdateConfiguredChannel(View):
         selected_channel_id = int(interaction.data['values'][0])
 
         # Do something with the selected channel (e.g., save it as the configured channel)
-        data = {
-            'server_id': self.server.id,
-            'channel_id': selected_channel_id
-        }
         selected_channel_name = self.server.get_channel(selected_channel_id).name
-        db_manager.update('MainChannel', data, f'(server_id = {self.server.id})')
+        await guild_config.update_main_channel(self.server.id, selected_channel_id)
         await interaction.response.send_message(f"Channel `{selected_channel_name}` has been selected.", ephemeral=True)
         await self.terminate_ui(interaction)
 
@@ -1,13 +1,122 @@
 import discord
 from discord.ui import Select, View, Modal, TextInput, Button
 
-from DatabaseManager import db_manager
+from DatabaseManager import db_manager, guild_config
+from core.constants import MESSAGES
+from core.fetcher import is_valid_url
+from core.routing import channel_cache
+
+# A select menu has at most 25 options
+FEEDS_PER_PAGE = 25
+
+
+class FeedPages:
+    # Pages through the RSS feeds of a guild ordered by name. Only the page shown is read
+    # from the database and kept, whatever the number of feeds of the guild.
+    def __init__(self, server_id: int, per_page: int = FEEDS_PER_PAGE):
+        self.server_id = server_id
+        self.per_page = per_page
+        self.page = 0
+        self.total = 0
+        self.feeds = []
+        self.has_next = False
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-self.total // self.per_page), self.page + 1 + self.has_next)
+
+    @property
+    def has_previous(self) -> bool:
+        return self.page > 0
+
+    def _set_feeds(self, rows):
+        # A row more than the page was read to know whether there is a next page
+        self.has_next = len(rows) > self.per_page
+        self.feeds = rows[:self.per_page]
+
+    async def load(self) -> bool:
+        # Reads the first page, False when the guild has no feeds
+        self.total = await guild_config.count_rss_feeds(self.server_id)
+        self.page = 0
+        self._set_feeds(await db_manager.get_rss_feeds_page(self.server_id, limit=self.per_page + 1))
+        return bool(self.feeds)
+
+    async def next(self):
+        if not self.feeds:
+            await self.load()
+            return
+        if not self.has_next:
+            return
+        last = self.feeds[-1]
+        rows = await db_manager.get_rss_feeds_page(self.server_id, after=(last['name'], last['url']),
+                                                   limit=self.per_page + 1)
+        if rows:
+            self.page += 1
+            self._set_feeds(rows)
+        else:
+            self.has_next = False
+
+    async def previous(self):
+        if not self.feeds:
+            await self.load()
+            return
+        if not self.has_previous:
+            return
+        first = self.feeds[0]
+        rows = await db_manager.get_rss_feeds_page(self.server_id, before=(first['name'], first['url']),
+                                                   limit=self.per_page)
+        if len(rows) < self.per_page:
+            # Feeds were deleted since, start over from the first page
+            await self.load()
+            return
+        self.page -= 1
+        self.feeds = rows
+        self.has_next = True
+
+
+def feed_options(feeds, value: str):
+    return [discord.SelectOption(
+        label=feed['name'],
+        value=feed[value],
+        description=f'{feed["url"][:100]} - {"Enabled" if feed["enabled"] else "Disabled"}')
+        for feed in feeds]
+
+
+class FeedPageView(View):
+    # Base of the views over a page of feeds, with Previous and Next buttons when there is more than a page
+    def __init__(self, pages: FeedPages):
+        super().__init__()
+        self.pages = pages
+        self.prev_button = Button(label="Previous", style=discord.ButtonStyle.primary)
+        self.prev_button.callback = self.prev_page
+        self.next_button = Button(label="Next", style=discord.ButtonStyle.primary)
+        self.next_button.callback = self.next_page
+
+    def add_page_buttons(self):
+        # Called once the selects are added, so the buttons come last
+        if self.pages.has_next or self.pages.has_previous:
+            self.add_item(self.prev_button)
+            self.add_item(self.next_button)
+
+    def update_page(self):
+        self.prev_button.disabled = not self.pages.has_previous
+        self.next_button.disabled = not self.pages.has_next
+
+    async def prev_page(self, interaction: discord.Interaction):
+        await self.pages.previous()
+        self.update_page()
+        await interaction.response.edit_message(view=self)
+
+    async def next_page(self, interaction: discord.Interaction):
+        await self.pages.next()
+        self.update_page()
+        await interaction.response.edit_message(view=self)
 
 
 # Create a class to handle the dropdowns and their interactions
-class DropdownRssHandler(View):
-    def __init__(self, ctx):
-        super().__init__()
+class DropdownRssHandler(FeedPageView):
+    def __init__(self, ctx, pages: FeedPages):
+        super().__init__(pages)
         self.rss_action = None
         self.rss_feeds = None
         self.guild = None  # Store the guild object
@@ -15,7 +124,16 @@ class DropdownRssHandler(View):
 
         # Add the dropdowns to the view
         self.add_item(self.RssActionDropdown(self))
-        self.add_item(self.RssSelector(self))
+        self.rss_selector = self.RssSelector(self)
+        self.add_item(self.rss_selector)
+        self.add_page_buttons()
+        self.update_page()
+
+    def update_page(self):
+        super().update_page()
+        # The selection is made on the page shown
+        self.rss_feeds = None
+        self.rss_selector.update_options()
 
     # handle selected interactions
     async def handle_selections(self, interaction):
@@ -35,8 +153,7 @@ class DropdownRssHandler(View):
                 # Save changes
                 data = {'enabled': action}
                 # ToDo: use the primary key and the db_manager.update_rss_feed
-                condition = f'(server_id = {self.ctx.message.guild.id} AND name = \'{rss_feed}\')'
-                db_manager.update('RssFeed', data, condition)
+                await guild_config.update_rss_feed_by_name(self.ctx.message.guild.id, rss_feed, data)
 
         feeds = '\n\t'.join(self.rss_feeds)
         await interaction.response.send_message(f'{self.rss_action} RSS Feeds:\n\t{feeds}', silent=True)
@@ -72,22 +189,13 @@ class DropdownRssHandler(View):
     class RssSelector(Select):
         def __init__(self, parent_view):
             self.parent_view = parent_view
+            super().__init__(placeholder="Select RSS Feeds", min_values=1)
 
-            options = []
-            rss_channels = db_manager.get_rss_feeds(self.parent_view.ctx.message.guild.id)
-            for config in rss_channels:
-                feed_server_id = config["server_id"]
-                feed_name = config["name"]
-                feed_url = config["url"]
-                channel_id = config["channel_id"]
-                enabled = config["enabled"]
-                # if self.parent_view.ctx.message.guild.id != feed_server_id:
-                #     continue
-                options.append(discord.SelectOption(label=feed_name,
-                                                    description=f'{feed_url[:100]} - {"Enabled" if enabled else "Disabled"}'))
-
-            super().__init__(placeholder="Select RSS Feeds", min_values=1, max_values=len(options),
-                             options=options)
+        def update_options(self):
+            pages = self.parent_view.pages
+            self.options = feed_options(pages.feeds, 'name')
+            self.max_values = max(len(self.options), 1)
+            self.placeholder = f"Select RSS Feeds (Page {pages.page + 1}/{pages.pages})"
 
         async def callback(self, interaction: discord.Interaction):
             self.parent_view.rss_feeds = self.values
@@ -109,15 +217,23 @@ class AddRssFeed(Modal, title='Add RSS Feed'):
         self.url = TextInput(label='URL', placeholder='Enter the RSS URL')
         self.channel = TextInput(label='Channel', placeholder='Enter a channel name for RSS')
         self.enabled = TextInput(label='Enabled', placeholder='Enter Yes or No')
+        self.digest = TextInput(label='Digest', placeholder='Group new entries in one message? Yes or No', required=False)
 
         # Add components to the modal
         self.add_item(self.name)
         self.add_item(self.url)
         self.add_item(self.channel)
         self.add_item(self.enabled)
+        self.add_item(self.digest)
 
     async def on_submit(self, interaction: discord.Interaction):
+        if not is_valid_url(str(self.url)):
+            await interaction.response.send_message(f"{MESSAGES['InvalidInput']} `{self.url}` is not an http(s) URL.",
+                                                    ephemeral=True, silent=True)
+            return
+
         enabled_bool = str(self.enabled).lower() == 'yes'
+        digest_bool = str(self.digest).lower() == 'yes'
         server_id = interaction.guild.id
         guild = interaction.guild
         channel_name = str(self.channel)
@@ -144,17 +260,19 @@ class AddRssFeed(Modal, title='Add RSS Feed'):
             'url': str(self.url),
             'channel_name': channel_name,
             'channel_id': int(channel.id),
-            'enabled': enabled_bool
+            'enabled': enabled_bool,
+            'digest': digest_bool
         }
 
         try:
-            db_manager.add_rss_feed(**feed)
+            await guild_config.add_rss_feed(**feed)
             await interaction.response.send_message(
                 f'RSS Feed added in **{interaction.guild.name}**!\n'
                 f'Name: {self.name}\n'
                 f'URL: {self.url}\n'
                 f'Channel: {channel_name}\n'
-                f'Enabled: {enabled_bool}',
+                f'Enabled: {enabled_bool}\n'
+                f'Digest: {digest_bool}',
                 silent=True
             )
         except Exception as error:
@@ -182,29 +300,27 @@ class AddRssFeedView(View):
         await interaction.message.delete()  # Delete the original message with the UI
 
 
-class UpdateRssFeedView(View):
-    def __init__(self, feeds):
-        super().__init__()
-        self.feeds = feeds
+class UpdateRssFeedView(FeedPageView):
+    def __init__(self, pages: FeedPages):
+        super().__init__(pages)
 
         # Create and add select menu manually
-        self.feed_select = Select(
-            placeholder="Select RSS feed to update",
-            min_values=1,
-            max_values=1,
-            options=[discord.SelectOption(
-                label=feed['name'],
-                value=feed['url'],
-                description=f'{feed["url"][:100]} - {"Enabled" if feed["enabled"] else "Disabled"}')
-                for feed in feeds]
-        )
+        self.feed_select = Select(min_values=1, max_values=1)
         self.feed_select.callback = self.on_feed_select
         self.add_item(self.feed_select)
+        self.add_page_buttons()
+        self.update_page()
+
+    def update_page(self):
+        super().update_page()
+        self.feed_select.options = feed_options(self.pages.feeds, 'url')
+        self.feed_select.placeholder = f"Select RSS feed to update (Page {self.pages.page + 1}/{self.pages.pages})"
 
     async def on_feed_select(self, interaction: discord.Interaction):
         server_id = interaction.guild.id
         selected_feed = self.feed_select.values[0]
-        await interaction.response.send_modal(UpdateRssFeed(selected_feed, server_id))
+        old_channel_id = next(feed['channel_id'] for feed in self.pages.feeds if feed['url'] == selected_feed)
+        await interaction.response.send_modal(UpdateRssFeed(selected_feed, server_id, old_channel_id))
         await self.terminate_ui(interaction)
 
     # Method to terminate the UI
@@ -214,13 +330,9 @@ class UpdateRssFeedView(View):
 
 
 class UpdateRssFeed(Modal, title='Update RSS Feed'):
-    def __init__(self, feed_url, feed_server_id):
+    def __init__(self, feed_url, feed_server_id, old_channel_id):
         super().__init__()
-        self.old_channel_id = db_manager.select(
-            tables=['RssFeed'],
-            columns=['channel_id'],
-            where_condition=f'url = \'{feed_url}\' AND server_id = {feed_server_id}')
-        self.old_channel_id = self.old_channel_id[0]['channel_id']
+        self.old_channel_id = old_channel_id
         self.feed_url = feed_url
         self.feed_server_id = feed_server_id
 
@@ -228,14 +340,21 @@ class UpdateRssFeed(Modal, title='Update RSS Feed'):
         self.url = TextInput(label='New URL', placeholder='Enter the new RSS URL', required=False)
         self.channel_name = TextInput(label='New Channel', placeholder='Enter a new channel name', required=False)
         self.enabled = TextInput(label='Enabled', placeholder='Enter Yes or No', required=False)
+        self.digest = TextInput(label='Digest', placeholder='Enter Yes or No', required=False)
 
         # Add components to the modal
         self.add_item(self.name)
         self.add_item(self.url)
         self.add_item(self.channel_name)
         self.add_item(self.enabled)
+        self.add_item(self.digest)
 
     async def on_submit(self, interaction: discord.Interaction):
+        if self.url.value and not is_valid_url(self.url.value):
+            await interaction.response.send_message(f"{MESSAGES['InvalidInput']} `{self.url.value}` is not an http(s) URL.",
+                                                    ephemeral=True, silent=True)
+            return
+
         category_name = 'RSS FEEDS'
         category = discord.utils.get(interaction.guild.categories, name=category_name)
 
@@ -251,7 +370,7 @@ class UpdateRssFeed(Modal, title='Update RSS Feed'):
         if self.channel_name.value:  # Ensure this checks the value, not the TextInput object itself
             channel = discord.utils.get(interaction.guild.text_channels, name=str(self.channel_name.value))
         else:
-            channel = await interaction.guild.fetch_channel(self.old_channel_id)
+            channel = await channel_cache.get(interaction.client, self.old_channel_id)
 
         if channel is None and self.channel_name.value:
             channel = await interaction.guild.create_text_channel(name=str(self.channel_name.value), category=category)
@@ -267,12 +386,14 @@ class UpdateRssFeed(Modal, title='Update RSS Feed'):
             updates['channel_id'] = int(channel.id)
         if self.enabled.value:
             updates['enabled'] = self.enabled.value.lower() == 'yes'
+        if self.digest.value:
+            updates['digest'] = self.digest.value.lower() == 'yes'
 
         # Update the RSS feed in your database
-        db_manager.update_rss_feed(server_id=self.feed_server_id, url=self.feed_url, data=updates)
+        await guild_config.update_rss_feed(server_id=self.feed_server_id, url=self.feed_url, data=updates)
 
         if 'channel_id' in updates:
-            channel = await interaction.guild.fetch_channel(updates['channel_id'])
+            # The channel found or created above
             updates['channel_name'] = channel.name
             del updates['channel_id']
 
@@ -286,34 +407,30 @@ class UpdateRssFeed(Modal, title='Update RSS Feed'):
         await interaction.response.send_message(f'Oops! Something went wrong: {error}', ephemeral=True, silent=True)
 
 
-class DeleteRssFeedView(View):
-    def __init__(self, feeds):
-        super().__init__()
-        self.feeds = feeds
+class DeleteRssFeedView(FeedPageView):
+    def __init__(self, pages: FeedPages):
+        super().__init__(pages)
 
         # Create and add select menu manually
-        self.feed_select = Select(
-            placeholder="Select RSS feed to delete",
-            min_values=1,
-            max_values=len(feeds),
-            options=[discord.SelectOption(
-                label=feed['name'],
-                value=feed['url'],
-                description=f'{feed["url"][:100]} - {"Enabled" if feed["enabled"] else "Disabled"}')
-                for feed in feeds]
-        )
+        self.feed_select = Select(min_values=1)
         self.feed_select.callback = self.on_feed_select
         self.add_item(self.feed_select)
+        self.add_page_buttons()
+        self.update_page()
+
+    def update_page(self):
+        super().update_page()
+        self.feed_select.options = feed_options(self.pages.feeds, 'url')
+        self.feed_select.max_values = max(len(self.feed_select.options), 1)
+        self.feed_select.placeholder = f"Select RSS feed to delete (Page {self.pages.page + 1}/{self.pages.pages})"
 
     async def on_feed_select(self, interaction: discord.Interaction):
         server_id = interaction.guild.id
         urls = self.feed_select.values
 
-        urls_str = "', '".join(urls)
-        condition = f'(server_id = {server_id} AND url IN (\'{urls_str}\'))'
-        db_manager.delete('RssFeed', condition)
+        await guild_config.delete_rss_feeds(server_id, urls)
 
-        deleted_names = [feed['name'] for feed in self.feeds if feed['url'] in urls]
+        deleted_names = [feed['name'] for feed in self.pages.feeds if feed['url'] in urls]
         await interaction.response.send_message(f'RSS Feeds deleted!\n\t' +
                                                 '\n\t'.join(deleted_names), silent=True)
         await self.terminate_ui(interaction)
@@ -0,0 +1,36 @@
+import asyncio
+import traceback
+
+import core.fetcher
+from DatabaseManager import PendingDeliveryBuffer, db_manager, history_buffer, subscriptions
+from core.constants import SCHEDULER_TICK
+from core.dedup import SeenEntries
+from core.metrics import start_metrics_server
+from core.pipeline import FeedPipeline
+from core.sharding import FeedPartition
+
+
+async def run_fetcher():
+    # Polls the feeds without connecting to Discord. The new entries are queued in the database
+    # and sent by the bot started with FETCH_MODE=external.
+    pending_deliveries = PendingDeliveryBuffer(db_manager)
+    feed_pipeline = FeedPipeline(db_manager, history_buffer, SeenEntries(db_manager),
+                                 pending_deliveries, FeedPartition(db_manager), subscriptions)
+    await start_metrics_server()
+    await history_buffer.load()
+    try:
+        while True:
+            try:
+                await feed_pipeline.tick()
+                await pending_deliveries.flush()
+            except Exception:
+                print(f"Error fetching the RSS feeds:")
+                print(traceback.format_exc())
+            await asyncio.sleep(SCHEDULER_TICK)
+    finally:
+        await core.fetcher.close()
+
+
+if __name__ == "__main__":
+    print('Fetcher started...')
+    asyncio.run(run_fetcher())
@@ -1,21 +1,26 @@
 import asyncio
+import io
 import traceback
 from datetime import datetime, timedelta
 
-import dateutil.parser as dt_parser
-import feedparser
-from dateutil.relativedelta import relativedelta
 from discord.ext import commands, tasks
 from discord.ui import Button
 
-from core.constants import MESSAGES, TOKEN
-from core.helpers import (update_rss_feeds, is_valid_user, delete_old_history)
+from DatabaseManager import db_manager, guild_config, history_buffer, subscriptions
+from core.constants import DELIVERY_POLL_INTERVAL, FETCH_MODE, MESSAGES, SCHEDULER_TICK, TOKEN
+from core.dedup import SeenEntries
+from core.delivery import DeliveryQueue
+from core import fetcher
+from core.helpers import (is_valid_user, delete_old_history)
+from core.metrics import DELIVERY_QUEUE_DEPTH, start_metrics_server
+from core.opml import import_opml as import_opml_feeds, write_opml
+from core.pipeline import FeedPipeline
+from core.routing import ChannelRouter, channel_cache
+from core.sharding import FeedPartition, get_shard_count, get_shard_ids, is_sharded
 from discord_embeds.admin_role_views import *
 from discord_embeds.configured_channel_views import *
 from discord_embeds.rss_views import *
 
-RSS_CHANNELS = update_rss_feeds()
-
 
 def main():
     # Define bot intents (including message content)
@@ -27,7 +32,23 @@ def main():
     # intents.guild_messages = True
 
     # Create a bot instance
-    bot = commands.Bot(command_prefix="!", intents=intents)
+    if is_sharded():
+        bot = commands.AutoShardedBot(command_prefix="!", intents=intents,
+                                      shard_count=get_shard_count(), shard_ids=get_shard_ids())
+    else:
+        bot = commands.Bot(command_prefix="!", intents=intents)
+
+    seen_entries = SeenEntries(db_manager)
+    # The feeds fetched by this process when several processes share the database
+    feed_partition = FeedPartition(db_manager)
+    # Resolves the channel of every delivery without scanning the guilds
+    channel_router = ChannelRouter(bot)
+    # Sends the new entries, decoupled from fetching
+    delivery_queue = DeliveryQueue(channel_router, history_buffer)
+    DELIVERY_QUEUE_DEPTH.set_function(delivery_queue.qsize)
+    # Polls the feeds on every tick of fetch_rss_feeds, unless the standalone fetcher does
+    feed_pipeline = FeedPipeline(db_manager, history_buffer, seen_entries, delivery_queue, feed_partition,
+                                 subscriptions)
 
     @bot.event
     async def on_ready():
@@ -36,29 +57,33 @@ def main():
         await bot.change_presence(activity=discord.Game(name="Use !help"))
 
         for guild in bot.guilds:
+            channel_router.index_guild(guild)
+
             # Save the guild information in the database
             try:
                 # add system channel
-                db_manager.add_main_channel(guild.id, guild.system_channel.id)
+                await guild_config.add_main_channel(guild.id, guild.system_channel.id)
             except Exception as error:
                 # handle missing system_channel by adding a random channel
                 if str(error).startswith("'NoneType' object has no attribute 'id'"):
-                    data = {
-                        'channel_id': guild.text_channels[0].id
-                    }
-                    db_manager.update_main_channel(guild.id, data)
+                    await guild_config.update_main_channel(guild.id, guild.text_channels[0].id)
                 elif not str(error).startswith('UNIQUE constraint failed'):
                     print(traceback.format_exc())
 
             try:
                 role = discord.utils.get(guild.roles, name='@everyone')
-                db_manager.add_accepted_role(guild.id, role.id)
+                await guild_config.add_accepted_role(guild.id, role.id)
             except Exception as error:
                 if not str(error).startswith('UNIQUE constraint failed'):
                     print(traceback.format_exc())
 
         # Check if the task is already running
-        if not fetch_rss_feeds.is_running():
+        if FETCH_MODE == 'external':
+            if not drain_pending_deliveries.is_running():
+                drain_pending_deliveries.start()
+            else:
+                print("Task 'drain_pending_deliveries' is already running.")
+        elif not fetch_rss_feeds.is_running():
             fetch_rss_feeds.start()
         else:
             print("Task 'fetch_rss_feeds' is already running.")
@@ -70,7 +95,7 @@ def main():
             print("Task 'check_connection' is already running.")
 
         # Start scheduler task
-        await asyncio.create_task(delete_old_history())
+        await asyncio.create_task(delete_old_history(feed_partition))
 
     @bot.event
     async def on_disconnect():
@@ -84,6 +109,8 @@ def main():
 
     @bot.event
     async def on_guild_join(guild):
+        channel_router.index_guild(guild)
+
         # Send a welcome message to the server's default channel (usually the first text channel)
         if guild.system_channel is not None:
             await guild.system_channel.send(MESSAGES['WelcomeMessage'])
@@ -91,24 +118,38 @@ def main():
         # Save the guild information in the database
         try:
             # add system channel
-            db_manager.add_main_channel(guild.id, guild.system_channel.id)
+            await guild_config.add_main_channel(guild.id, guild.system_channel.id)
         except Exception as error:
             # handle missing system_channel by adding a random channel
             if str(error).startswith("'NoneType' object has no attribute 'id'"):
-                data = {
-                    'channel_id': guild.text_channels[0].id
-                }
-                db_manager.update_main_channel(guild.id, data)
+                await guild_config.update_main_channel(guild.id, guild.text_channels[0].id)
             elif not str(error).startswith('UNIQUE constraint failed'):
                 print(traceback.format_exc())
 
         try:
             role = discord.utils.get(guild.roles, name='@everyone')
-            db_manager.add_accepted_role(guild.id, role.id)
+            await guild_config.add_accepted_role(guild.id, role.id)
         except Exception as error:
             if not str(error).startswith('UNIQUE constraint failed'):
                 print(traceback.format_exc())
 
+    @bot.event
+    async def on_guild_remove(guild):
+        channel_router.remove_guild(guild)
+        guild_config.invalidate(guild.id)
+
+    @bot.event
+    async def on_guild_channel_create(channel):
+        channel_router.add_channel(channel)
+
+    @bot.event
+    async def on_guild_channel_delete(channel):
+        channel_router.remove_channel(channel)
+
+    @bot.event
+    async def on_guild_channel_update(before, after):
+        channel_router.update_channel(before, after)
+
     @bot.command(name='ping', description='Ping Pong!')
     async def ping(ctx):
         # if await is_valid_user(ctx):
@@ -128,15 +169,11 @@ def main():
     @bot.command(name='server_name', description='Print the current server name')
     async def server_name(ctx):
         # if await is_valid_user(ctx):
-        channel_id = db_manager.get_main_channel(ctx.guild.id)
-        channel_id = channel_id[0]['channel_id']
-        try:
-            channel = await bot.fetch_channel(channel_id)
-        except Exception:
-            channel = channel_id
+        channel_id = await guild_config.get_main_channel(ctx.guild.id)
+        channel = await channel_cache.get(bot, channel_id) if channel_id is not None else None
         if ctx.channel.id == channel_id:
             await ctx.send(f'The current server is `{ctx.message.guild.name}` with id `{ctx.message.guild.id}`.', silent=True)
-        elif channel == channel_id:
+        elif channel is None:
             await ctx.send(f"Unknown Main Channel with id `{channel_id}`.\nUse `!update_main_channel` to configure a new main channel for the server.",
                            silent=True)
         else:
@@ -146,13 +183,9 @@ def main():
     @bot.command(name='get_main_channel', description='Get The configured channel')
     async def get_main_channel(ctx):
         # if await is_valid_user(ctx):
-        channel_id = db_manager.get_main_channel(ctx.guild.id)
-        channel_id = channel_id[0]['channel_id']
-        try:
-            channel = await bot.fetch_channel(channel_id)
-        except Exception:
-            channel = channel_id
-        if channel == channel_id:
+        channel_id = await guild_config.get_main_channel(ctx.guild.id)
+        channel = await channel_cache.get(bot, channel_id) if channel_id is not None else None
+        if channel is None:
             await ctx.send(f"Unknown Main Channel with id `{channel_id}`.\nUse `!update_main_channel` to configure a new main channel for the server.",
                            silent=True)
             return
@@ -166,12 +199,12 @@ def main():
     @bot.command(name='update_admin_role', description='Update the required admin role')
     async def update_admin_role(ctx):
         if await is_valid_user(ctx):
-            await ctx.send(f'Update the admin role', view=UpdateAdminRole(ctx), silent=True)
+            server_role = await guild_config.get_accepted_role(ctx.guild.id)
+            await ctx.send(f'Update the admin role', view=UpdateAdminRole(ctx, server_role), silent=True)
 
     @bot.command(name='get_admin_role', description='Get The admin role')
     async def get_admin_role(ctx):
-        role_id = db_manager.get_accepted_role(ctx.guild.id)
-        role_id = role_id[0]['role_id']
+        role_id = await guild_config.get_accepted_role(ctx.guild.id)
 
         # Check if the role is the @everyone role
         if role_id == ctx.guild.id:
@@ -196,12 +229,12 @@ def main():
     @bot.command(name='update_rss_feed', description='Update an existing RSS Feed')
     async def update_rss_feed(ctx):
         if await is_valid_user(ctx):
-            feeds = db_manager.get_rss_feeds(ctx.message.guild.id)
-            if not feeds:
+            pages = FeedPages(ctx.message.guild.id)
+            if not await pages.load():
                 await ctx.send(f"```markdown\n{MESSAGES['NoRssFound']}```", silent=True)
                 return
 
-            await ctx.send("Select the RSS feed you want to update:", view=UpdateRssFeedView(feeds), silent=True)
+            await ctx.send("Select the RSS feed you want to update:", view=UpdateRssFeedView(pages), silent=True)
 
     @bot.command(name='delete_rss_feeds', description='Delete one or multiple RSS feeds')
     async def delete_rss_feeds(ctx):
@@ -211,103 +244,130 @@ def main():
             #     tables=['RssFeed'],
             #     where_condition=f'server = \'{ctx.message.guild.name}\''
             # )
-            feeds = db_manager.get_rss_feeds(ctx.message.guild.id)
-            if not feeds:
+            pages = FeedPages(ctx.message.guild.id)
+            if not await pages.load():
                 await ctx.send(f"```markdown\n{MESSAGES['NoRssFound']}```", silent=True)
                 return
 
-            await ctx.send("Select the RSS feeds you want to delete:", view=DeleteRssFeedView(feeds), silent=True)
+            await ctx.send("Select the RSS feeds you want to delete:", view=DeleteRssFeedView(pages), silent=True)
 
     @bot.command(name='get_rss_feeds', description='Get Server RSS Feeds')
     async def get_rss_feeds(ctx):
-        feeds = db_manager.get_rss_feeds(ctx.message.guild.id)
-        if not feeds:
+        # Split feeds into pages with 5 feeds per page, read one at a time
+        pages = FeedPages(ctx.message.guild.id, per_page=5)
+        if not await pages.load():
             await ctx.send(f"```markdown\n# {MESSAGES['NoRssFound']}```", silent=True)
             return
 
         async def find_channel_name(feed):
-            feed['channel'] = await bot.fetch_channel(feed['channel_id'])
-            if feed['channel'] is None:
-                feed['channel'] = 'Unknown Channel'
-            return feed
-
-        feeds = await asyncio.gather(*map(find_channel_name, feeds))
+            channel = await channel_cache.get(bot, feed['channel_id'])
+            if channel is None:
+                channel = 'Unknown Channel'
+            return channel
 
-        # Split feeds into pages with 5 feeds per page
-        feeds_per_page = 5
-        pages = [feeds[i:i + feeds_per_page] for i in range(0, len(feeds), feeds_per_page)]
-
-        # Function to create embed for a specific page
-        def create_embed(page_number):
+        # Function to create embed for the current page, only its channels are looked up
+        async def create_embed():
             embed = discord.Embed(
-                title=f"RSS Feeds for {ctx.message.guild.name} (Page {page_number + 1}/{len(pages)})",
+                title=f"RSS Feeds for {ctx.message.guild.name} (Page {pages.page + 1}/{pages.pages})",
                 color=discord.Color.blue()
             )
-            for feed in pages[page_number]:
+            channels = await asyncio.gather(*map(find_channel_name, pages.feeds))
+            for feed, channel in zip(pages.feeds, channels):
                 name = feed['name']
                 url = feed['url']
-                channel = feed['channel']
                 enabled = 'Yes' if feed['enabled'] else 'No'
+                digest = 'Yes' if feed['digest'] else 'No'
                 embed.add_field(
                     name=f"__**{name}**__",
-                    value=f"**URL:** {url}\n**Channel:** {channel}\n**Enabled:** {enabled}",
+                    value=f"**URL:** {url}\n**Channel:** {channel}\n**Enabled:** {enabled}\n**Digest:** {digest}",
                     inline=False
                 )
             return embed
 
         # Initialize first embed
-        current_page = 0
-        embed = create_embed(current_page)
+        embed = await create_embed()
 
         # Create buttons
         class PaginatorView(View):
             def __init__(self):
                 super().__init__()
-                self.current_page = 0
                 # Initialize buttons with correct disabled states
                 self.update_buttons()
 
             # Method to update the buttons' disabled states based on current page
             def update_buttons(self):
                 # Disable 'Previous' if on the first page
-                self.children[0].disabled = self.current_page == 0
+                self.children[0].disabled = not pages.has_previous
                 # Disable 'Next' if on the last page
-                self.children[1].disabled = self.current_page == len(pages) - 1
+                self.children[1].disabled = not pages.has_next
 
             # Next button
             @discord.ui.button(label='Previous', style=discord.ButtonStyle.primary)
             async def previous_button(self, interaction: discord.Interaction, button: Button):
-                if self.current_page > 0:
-                    self.current_page -= 1
+                if pages.has_previous:
+                    await pages.previous()
                     self.update_buttons()  # Update button states
-                    await interaction.response.edit_message(embed=create_embed(self.current_page), view=self)
+                    await interaction.response.edit_message(embed=await create_embed(), view=self)
 
             # Previous button
             @discord.ui.button(label='Next', style=discord.ButtonStyle.primary)
             async def next_button(self, interaction: discord.Interaction, button: Button):
-                if self.current_page < len(pages) - 1:
-                    self.current_page += 1
+                if pages.has_next:
+                    await pages.next()
                     self.update_buttons()  # Update button states
-                    await interaction.response.edit_message(embed=create_embed(self.current_page), view=self)
+                    await interaction.response.edit_message(embed=await create_embed(), view=self)
 
         # Send the initial message with the first embed and the paginator view
         await ctx.send(embed=embed, view=PaginatorView(), silent=True)
 
+    @bot.command(name='import_opml', description='Add the RSS feeds of an attached OPML file')
+    async def import_opml(ctx, enabled: str = 'yes', digest: str = 'no'):
+        if await is_valid_user(ctx):
+            if not ctx.message.attachments:
+                await ctx.send('Attach the OPML file to import to the command.', silent=True)
+                return
+
+            async with ctx.typing():
+                try:
+                    result = await import_opml_feeds(ctx.guild, channel_router, ctx.message.attachments[0].url,
+                                                     enabled=enabled.lower() == 'yes', digest=digest.lower() == 'yes')
+                except Exception as error:
+                    print(traceback.format_exc())
+                    await ctx.send(f'Could not import the OPML file: {error}', silent=True)
+                    return
+
+            message = f'Imported {len(result.added)} RSS feeds.'
+            if result.existing:
+                message += f'\nSkipped {len(result.existing)} RSS feeds already added.'
+            if result.invalid:
+                # Keep the message under the 2000 characters limit of Discord
+                failed = '\n\t'.join(feed.url for feed in result.invalid[:20])
+                more = f'\n\t... and {len(result.invalid) - 20} more' if len(result.invalid) > 20 else ''
+                message += f'\nCould not add {len(result.invalid)} RSS feeds:\n\t{failed}{more}'
+            await ctx.send(message[:2000], silent=True)
+
+    @bot.command(name='export_opml', description='Export the RSS feeds of the server as OPML')
+    async def export_opml(ctx):
+        if await is_valid_user(ctx):
+            feeds = await db_manager.get_rss_feeds(ctx.guild.id)
+            if not feeds:
+                await ctx.send(f"```markdown\n{MESSAGES['NoRssFound']}```", silent=True)
+                return
+
+            data = write_opml(f'RSS Feeds for {ctx.guild.name}', feeds)
+            await ctx.send(f'Exported {len(feeds)} RSS feeds.',
+                           file=discord.File(io.BytesIO(data), filename='rss-feeds.opml'), silent=True)
+
     # Command to send the dropdown menu
     @bot.command(name='configure_rss_feeds', description='Enable or Disable existing RSS Feeds')
     async def configure_rss_feeds(ctx):
         if await is_valid_user(ctx):
-            global RSS_CHANNELS
-            RSS_CHANNELS = update_rss_feeds()
-            if len(RSS_CHANNELS) == 0:
-                await ctx.send(f"```markdown\n{MESSAGES['NoRssFound']}```", silent=True)
-                return
-            server_feeds = [feed['server_id'] for feed in RSS_CHANNELS if feed['server_id'] == ctx.message.guild.id]
-            if len(server_feeds) == 0:
+            pages = FeedPages(ctx.message.guild.id)
+            if not await pages.load():
                 await ctx.send(f"```markdown\n{MESSAGES['NoRssFound']}```", silent=True)
                 return
 
-            view = DropdownRssHandler(ctx)
+            view = DropdownRssHandler(ctx, pages)
             await ctx.send("Configuring RSS Feeds", view=view, silent=True)
 
 
@@ -335,119 +395,39 @@ def main():
 
         await asyncio.sleep((target_time - now).total_seconds())
 
-    @tasks.loop(minutes=1)  # Set the interval to fetch the RSS feeds
+    @tasks.loop(seconds=SCHEDULER_TICK)  # Set the interval to check for feeds due to be fetched
     async def fetch_rss_feeds():
-        print("Sending RSS Feeds...")
-
-        global RSS_CHANNELS
-        feed_history = db_manager.select(
-            tables=['RssFeed', 'RssHistory'],
-            columns=['RssFeed.server_id', 'RssFeed.url',
-                     'max(RssHistory.timestamp) AS timestamp'],
-            join_conditions=[
-                'RssFeed.server_id = RssHistory.server_id AND RssFeed.url = RssHistory.url'],
-            group_by=['RssFeed.server_id', 'RssFeed.url'],
-            order_by=['RssHistory.timestamp DESC'])
-
-        RSS_CHANNELS = update_rss_feeds()
-
-        for rss_channel in RSS_CHANNELS:
-            feed_name = rss_channel['name']
-            server_id = rss_channel['server_id']
-            feed_url = rss_channel['url']
-            channel_name = rss_channel['channel_name']
-            channel_id = rss_channel['channel_id']
-            enabled = rss_channel['enabled']
-            if not enabled:
-                continue
-
-            # Fetch and parse the RSS feed in a thread
-            try:
-                feed = await asyncio.to_thread(feedparser.parse, feed_url)
-            except Exception as e:
-                print(f"Failed to fetch RSS feeds:")
-                print(traceback.format_exc())
-                continue
-
-            # Handle Discord guilds and channels
-            category_name = 'RSS FEEDS'
-            channels = []
-            for guild in bot.guilds:
-                if guild.id != server_id:
-                    continue
-
-                category = discord.utils.get(guild.categories, name=category_name)
-                if category is None:
-                    try:
-                        category = await guild.create_category(name=category_name)
-                        print(f"Created category: {category_name}")
-                    except Exception as e:
-                        print(f'Error creating category \'{category_name}\' in server \'{guild.name}\':')
-                        print(traceback.format_exc())
-
-                existing_channels = {channel.id for channel in guild.text_channels}
-                if channel_id not in existing_channels:
-                    try:
-                        existing_channel = discord.utils.get(guild.text_channels, name=channel_name)
-                        if existing_channel is not None:
-                            channel_id = existing_channel.id
-                            db_manager.update_rss_feed(server_id, feed_url, {'channel_id': channel_id})
-                        else:
-                            new_channel = await guild.create_text_channel(name=channel_name, category=category)
-                            if new_channel is not None:
-                                channel_id = new_channel.id
-                                db_manager.update_rss_feed(server_id, feed_url, {'channel_id': channel_id})
-                            print(f"Created channel: {channel_name} in category {category_name}")
-                    except Exception as e:
-                        print(f'Error creating channel \'{channel_name}\' in server \'{guild.name}\':')
-                        print(traceback.format_exc())
-
-                for ch in guild.text_channels:
-                    if ch.id == channel_id:
-                        channels.append(ch)
-
-            if not channels:
-                print(f"Channel for feed {feed_name} not found!")
-                continue
-
-            # Fetch the latest RSS entries from the feed
-            rss_entry = [entries for entries in feed_history if
-                         entries['server_id'] == server_id and entries['url'] == feed_url]
-            if not rss_entry:
-                rss_entry = {"server_id": server_id, "url": feed_url, "timestamp": datetime.now() - relativedelta(months=1)}
-            else:
-                rss_entry = rss_entry[0]
-                rss_entry['timestamp'] = dt_parser.parse(rss_entry["timestamp"])
-
-            if feed:
-                feed.entries.reverse()
-                # Check for new entries and send them to Discord channels
-                for entry in feed.entries:
-                    entry_time = datetime(*entry.published_parsed[:6])
-                    if entry_time > rss_entry["timestamp"]:
-                        rss_entry['timestamp'] = entry_time
-                        rss_entry['title'] = entry.title
-                        for channel in channels:
-                            try:
-                                await channel.send(f"**{feed.feed.title}**\n{entry.link}\n", silent=True)
-                                db_manager.add_rss_history(**rss_entry)
-                            except Exception as error:
-                                if not str(error).startswith('UNIQUE constraint failed'):
-                                    print(f"Error sending the RSS feed:")
-                                    print(traceback.format_exc())
-                                else:
-                                    server_id = rss_entry['server_id']
-                                    url = rss_entry['url']
-                                    title = rss_entry['title']
-                                    data = {
-                                        'timestamp': rss_entry['timestamp']
-                                    }
-                                    db_manager.update_rss_history(server_id=server_id, url=url, title=title, data=data)
-                                    # print(f'Error sending the RSS Feed \'{feed.feed.title}\' from url \'{entry.link}\' to channel \'{channel.name}\': {error}')
+        # tasks.loop stops for good on most errors, a locked database must only cost a tick
+        try:
+            await feed_pipeline.tick()
+        except Exception:
+            print(f"Error fetching the RSS feeds:")
+            print(traceback.format_exc())
+
+    @tasks.loop(seconds=DELIVERY_POLL_INTERVAL)  # Set the interval to check for entries queued by the fetcher
+    async def drain_pending_deliveries():
+        # Write the history of everything sent since the last check in one transaction
+        try:
+            await history_buffer.flush()
+        except Exception:
+            print(f"Error saving the RSS history:")
+            print(traceback.format_exc())
+
+        try:
+            await delivery_queue.drain_pending(db_manager)
+        except Exception:
+            print(f"Error reading the queued RSS feeds:")
+            print(traceback.format_exc())
+
+    @drain_pending_deliveries.before_loop
+    async def before_drain_pending_deliveries():
+        await bot.wait_until_ready()
+        await history_buffer.load()
 
     @fetch_rss_feeds.before_loop
     async def before_fetch_rss_feeds():
         await bot.wait_until_ready()
+        await history_buffer.load()
 
         now = datetime.now()
         target_time = now.replace(second=0, microsecond=0)
@@ -458,6 +438,7 @@ def main():
         await asyncio.sleep((target_time - now).total_seconds())
 
     async def run_bot():
+        await start_metrics_server()
         while True:
             try:
                 async with bot:
@@ -465,6 +446,9 @@ def main():
             except Exception as e:
                 print(f"Bot crashed:")
                 print(traceback.format_exc())
+            finally:
+                # Drop the pooled feed connections, a fresh session is opened by the next fetch
+                await fetcher.close()
                 # sys.exit(1)
                 # print("Reconnecting in 60 seconds...")
                 # await asyncio.sleep(60)
@@ -0,0 +1,51 @@
+import unittest
+from datetime import datetime, timedelta
+
+from core.dedup import entry_hash
+from core.parser import ParsedEntry, StreamingFeedParser, parse_feed
+
+START = datetime(2024, 1, 1)
+
+
+def rss(guids):
+    # guid gN is published N hours after START
+    items = ''.join(f'<item><guid>g{n}</guid><title>{n}</title>'
+                    f'<pubDate>{(START + timedelta(hours=n)).strftime("%a, %d %b %Y %H:%M:%S +0000")}</pubDate></item>'
+                    for n in guids)
+    return f'<rss version="2.0"><channel><title>feed</title>{items}</channel></rss>'.encode()
+
+
+def known(guids):
+    return frozenset(entry_hash(ParsedEntry(f'g{n}', None, None, None)) for n in guids)
+
+
+def ids(feed):
+    return [entry.id for entry in feed.entries]
+
+
+class ParseFeedTest(unittest.TestCase):
+    def test_newest_first_stops_after_known_entries(self):
+        feed = parse_feed(rss(range(9, -1, -1)), known=known(range(8)))
+        self.assertEqual(ids(feed)[:2], ['g9', 'g8'])
+        self.assertLess(len(feed.entries), 10)
+
+    def test_oldest_first_reads_new_entries_at_the_end(self):
+        feed = parse_feed(rss(range(10)), known=known(range(8)))
+        self.assertIn('g8', ids(feed))
+        self.assertIn('g9', ids(feed))
+
+    def test_newest_first_keeps_the_first_entries(self):
+        parser = StreamingFeedParser(max_entries=3)
+        parser.feed(rss(range(9, -1, -1)))
+        parser.close()
+        self.assertEqual(ids(parser.result()), ['g9', 'g8', 'g7'])
+
+    def test_oldest_first_keeps_the_newest_entries(self):
+        parser = StreamingFeedParser(max_entries=3)
+        parser.feed(rss(range(10)))
+        parser.close()
+        self.assertEqual(ids(parser.result()), ['g7', 'g8', 'g9'])
+
+
+if __name__ == '__main__':
+    unittest.main()